@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+"""
+Generate a reproducible synthetic xsgit repo for the benchmarks
+
+The same arguments and seed always give the same history: files of
+lognormal sizes spread over nested directories, commits editing a few of
+them on the main branch or on side branches, and side branches merged back
+into main at regular intervals. Each side branch is left with commits main
+doesn't have, and main is checked out at the end
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+
+# Use the xsgit on PYTHONPATH, the run script points it at the revision
+# being measured, and fall back to the one of this checkout
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xsgit import base, data  # noqa: E402
+
+# Files are text, in lines of this many characters
+_LINE_LENGTH = 40
+
+# Bigger files are capped, a lognormal spread has a very long tail
+_MAX_SIZE = 1 << 20
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("path", help="directory of the new repo")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--files", type=int, default=200,
+                        help="files in the first commit")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="deepest directory nesting")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="subdirectories per directory")
+    parser.add_argument("--size", type=int, default=1024,
+                        help="median file size in bytes")
+    parser.add_argument("--size-spread", type=float, default=1.0,
+                        help="sigma of the lognormal file sizes")
+    parser.add_argument("--commits", type=int, default=30)
+    parser.add_argument("--changes", type=int, default=5,
+                        help="files edited per commit on average")
+    parser.add_argument("--branches", type=int, default=2,
+                        help="side branches next to main")
+    parser.add_argument("--merge-every", type=int, default=10,
+                        help="commits between merges into main, 0 for none")
+    return parser.parse_args(argv)
+
+
+class Generator:
+    """
+    Builds the history straight into the object store, the working tree
+    is only written by the final checkout
+    Only data.hash_object and data.update_ref are used to store it, so the
+    same repos can be generated for every revision down to the first
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.count = 0
+        # Content of every blob written, for the edits
+        self.contents = {}
+        # Trees already written
+        self.trees = set()
+        # Per branch: tip, path to oid, the files of main it started from
+        # and the paths it changed since
+        self.branches = {}
+
+    def random_path(self, i):
+        depth = self.rng.randint(0, self.args.depth)
+        dirs = [f"d{self.rng.randrange(self.args.fanout)}"
+                for _ in range(depth)]
+        return "/".join(dirs + [f"f{i}.txt"])
+
+    def random_blob(self):
+        size = self.rng.lognormvariate(0, self.args.size_spread)
+        size = min(int(self.args.size * size), _MAX_SIZE)
+        lines = max(1, size // (_LINE_LENGTH + 1))
+        raw = self.rng.randbytes(lines * _LINE_LENGTH // 2).hex()
+        return self.write_blob("".join(
+            f"{raw[i:i + _LINE_LENGTH]}\n"
+            for i in range(0, len(raw), _LINE_LENGTH)).encode())
+
+    def edit_blob(self, oid):
+        """
+        Replace one line, so diffs and merges see small hunks
+        """
+        lines = self.contents[oid].splitlines(keepends=True)
+        i = self.rng.randrange(len(lines))
+        lines[i] = self.rng.randbytes(_LINE_LENGTH // 2).hex().encode() + \
+            b"\n"
+        return self.write_blob(b"".join(lines))
+
+    def write_blob(self, content):
+        oid = data.hash_object(content)
+        self.contents[oid] = content
+        return oid
+
+    def write_tree(self, files):
+        """
+        Store the flat dict of path to oid as nested trees, return the oid
+        of the root
+        Trees are hashed here and only stored when not written before
+        """
+        nested = {}
+        for path, oid in files.items():
+            *dirs, name = path.split("/")
+            curr = nested
+            for dirname in dirs:
+                curr = curr.setdefault(dirname, {})
+            curr[name] = oid
+
+        def write(tree):
+            entries = sorted(
+                (name, "tree", write(value)) if isinstance(value, dict)
+                else (name, "blob", value)
+                for name, value in tree.items())
+            raw = "".join(f"{type_} {oid} {name}\n"
+                          for name, type_, oid in entries).encode()
+            oid = hashlib.sha1(b"tree\x00" + raw).hexdigest()
+            if oid not in self.trees:
+                data.hash_object(raw, "tree")
+                self.trees.add(oid)
+            return oid
+
+        return write(nested)
+
+    def commit(self, name, files, parents):
+        """
+        Store the files as a commit of parents, return its oid
+        """
+        root = self.write_tree(files)
+
+        self.count += 1
+        msg = f"tree {root}\n"
+        msg += "".join(f"parent {parent}\n" for parent in parents)
+        msg += f"\nCommit {self.count} on {name}\n"
+        return data.hash_object(msg.encode(), "commit")
+
+    def commit_on(self, name):
+        """
+        Edit a few files of a branch, sometimes adding one, and commit
+        """
+        branch = self.branches[name]
+        files = dict(branch["files"])
+        changes = max(1, round(self.rng.expovariate(1 / self.args.changes)))
+        for path in self.rng.sample(sorted(files), min(changes, len(files))):
+            files[path] = self.edit_blob(files[path])
+            branch["changed"].add(path)
+        if self.rng.random() < 0.2:
+            path = self.random_path(self.count + self.args.files)
+            files[path] = self.random_blob()
+            branch["changed"].add(path)
+
+        branch["tip"] = self.commit(name, files, [branch["tip"]])
+        branch["files"] = files
+
+    def merge(self, name):
+        """
+        Merge a side branch into main and restart it from the merge
+        Main keeps its version of the files both of them changed
+        """
+        main, side = self.branches["main"], self.branches[name]
+        files = dict(main["files"])
+        for path in side["changed"]:
+            if files.get(path) == side["base"].get(path):
+                files[path] = side["files"][path]
+
+        main["tip"] = self.commit("main", files, [main["tip"], side["tip"]])
+        main["files"] = files
+        self.fork(name)
+
+    def fork(self, name):
+        main = self.branches["main"]
+        self.branches[name] = {"tip": main["tip"], "files": main["files"],
+                               "base": main["files"], "changed": set()}
+
+    def generate(self):
+        files = {}
+        for i in range(self.args.files):
+            files[self.random_path(i)] = self.random_blob()
+        tip = self.commit("main", files, [])
+
+        self.branches["main"] = {"tip": tip, "files": files,
+                                 "base": files, "changed": set()}
+        sides = [f"b{i}" for i in range(1, self.args.branches + 1)]
+        for name in sides:
+            self.fork(name)
+
+        while self.count < self.args.commits:
+            if sides and self.args.merge_every and \
+                    self.count % self.args.merge_every == 0:
+                self.merge(self.rng.choice(sides))
+            else:
+                self.commit_on(self.rng.choice(["main"] + sides))
+        # Leave every side branch something to merge
+        for name in sides:
+            self.commit_on(name)
+
+        for name, branch in self.branches.items():
+            data.update_ref(f"refs/heads/{name}",
+                            data.RefValue(symbolic=False, value=branch["tip"]))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.path)
+    os.chdir(args.path)
+    with data.change_git_dir("."):
+        base.init()
+        Generator(args).generate()
+        base.checkout("main")
+
+
+if __name__ == "__main__":
+    main()
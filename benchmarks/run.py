@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+"""
+Time xsgit commands on synthetic repos of several scales
+
+Every run starts from a fresh copy of the generated repo and times one
+command as the user would run it, interpreter start included. Results are
+written as JSON, a previous results file given to --compare is shown next
+to the new one, so revisions can be compared on the same machine
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Arguments of generate.py for each scale
+SCALES = {
+    "small": {"files": 200, "depth": 3, "commits": 30, "branches": 2,
+              "merge-every": 10},
+    "medium": {"files": 2000, "depth": 4, "commits": 100, "branches": 4,
+               "merge-every": 15},
+    "large": {"files": 10000, "depth": 5, "commits": 300, "branches": 8,
+              "merge-every": 20},
+}
+
+# Files edited in the working tree before add, commit, status and diff
+EDITS = 20
+
+_MAIN = "from xsgit.cli import main; main()"
+
+
+class Bench:
+    """
+    Runs the commands of the xsgit found in source on copies of a repo
+    """
+
+    def __init__(self, source, workdir):
+        self.env = dict(os.environ, PYTHONPATH=source)
+        self.workdir = workdir
+
+    def xsgit(self, cwd, *args):
+        # Through cli.main, older revisions have no __main__ module
+        subprocess.run([sys.executable, "-c", _MAIN, *args], cwd=cwd,
+                       env=self.env, check=True, stdout=subprocess.DEVNULL)
+
+    def generate(self, name, params, seed):
+        path = f"{self.workdir}/{name}"
+        args = [f"--{key}={value}" for key, value in params.items()]
+        subprocess.run([sys.executable, f"{ROOT}/benchmarks/generate.py",
+                        path, f"--seed={seed}", *args], env=self.env,
+                       check=True)
+        return path
+
+    def copy(self, template, run):
+        """
+        Fresh copy of the repo, with the stat data of the index refreshed
+        since copied files get new inodes
+        """
+        path = f"{run}/repo"
+        shutil.copytree(template, path, symlinks=True)
+        self.xsgit(path, "status")
+        return path
+
+    def edit(self, repo):
+        """
+        Append a line to the first files of the working tree
+        """
+        edited = 0
+        for root, dirs, fnames in os.walk(repo):
+            dirs[:] = sorted(d for d in dirs if d != ".xsgit")
+            for fname in sorted(fnames):
+                if edited == EDITS:
+                    return
+                with open(f"{root}/{fname}", "a") as f:
+                    f.write("benchmark edit\n")
+                edited += 1
+
+    def empty_repo(self, repo):
+        """
+        New repo next to the copy, to fetch or push into
+        """
+        path = f"{os.path.dirname(repo)}/remote"
+        os.mkdir(path)
+        self.xsgit(path, "init")
+        return path
+
+    # Each op prepares a copy of the repo, returns where to run which
+    # command
+
+    def op_add(self, repo):
+        self.edit(repo)
+        return repo, ["add", "."]
+
+    def op_commit(self, repo):
+        self.edit(repo)
+        self.xsgit(repo, "add", ".")
+        return repo, ["commit", "-m", "benchmark"]
+
+    def op_status(self, repo):
+        self.edit(repo)
+        return repo, ["status"]
+
+    def op_diff(self, repo):
+        self.edit(repo)
+        return repo, ["diff"]
+
+    def op_log(self, repo):
+        return repo, ["log"]
+
+    def op_checkout(self, repo):
+        return repo, ["checkout", "b1"]
+
+    def op_merge(self, repo):
+        return repo, ["merge", "b1"]
+
+    def op_fetch(self, repo):
+        return self.empty_repo(repo), ["fetch", repo]
+
+    def op_push(self, repo):
+        return repo, ["push", self.empty_repo(repo), "main"]
+
+    def time(self, template, op, repeat):
+        runs = []
+        for _ in range(repeat):
+            run = tempfile.mkdtemp(dir=self.workdir)
+            cwd, args = getattr(self, f"op_{op}")(self.copy(template, run))
+            start = time.perf_counter()
+            self.xsgit(cwd, *args)
+            runs.append(time.perf_counter() - start)
+            shutil.rmtree(run)
+        return {"runs": runs, "min": min(runs),
+                "median": statistics.median(runs)}
+
+
+OPS = [name[3:] for name in vars(Bench) if name.startswith("op_")]
+
+
+def get_revision(source):
+    """
+    Commit of the source being measured, None out of a git checkout
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=source, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print the medians of both results side by side
+    """
+    print(f"{'scale':8} {'op':10} {'baseline':>10} {'new':>10} {'ratio':>7}",
+          file=sys.stderr)
+    for scale, result in results["scales"].items():
+        old = baseline["scales"].get(scale, {}).get("ops", {})
+        for op, timing in result["ops"].items():
+            if op not in old:
+                continue
+            before, after = old[op]["median"], timing["median"]
+            print(f"{scale:8} {op:10} {before:10.3f} {after:10.3f} "
+                  f"{after / before:7.2f}", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", nargs="+", choices=SCALES,
+                        default=["small", "medium"])
+    parser.add_argument("--ops", nargs="+", choices=OPS, default=OPS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--source", default=ROOT,
+                        help="directory holding the xsgit to measure")
+    parser.add_argument("-o", "--output",
+                        help="JSON results file, stdout by default")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    source = os.path.abspath(args.source)
+    results = {
+        "revision": get_revision(source),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "scales": {},
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bench = Bench(source, workdir)
+        for scale in args.scales:
+            params = SCALES[scale]
+            start = time.perf_counter()
+            template = bench.generate(scale, params, args.seed)
+            result = results["scales"][scale] = {
+                "params": params,
+                "generate": time.perf_counter() - start,
+                "ops": {},
+            }
+            for op in args.ops:
+                result["ops"][op] = bench.time(template, op, args.repeat)
+                print(f"{scale:8} {op:10} "
+                      f"{result['ops'][op]['median']:8.3f}s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import itertools
+import tempfile
+import unittest
+
+from unittest import mock
+
+from xsgit import base, data
+
+
+class MergeBaseTest(unittest.TestCase):
+    """
+    Merge bases of a repo without a commit graph, where every generation
+    is unknown
+    """
+
+    def setUp(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(data.change_git_dir(tmp))
+        data.init()
+        self.tree = base.write_tree_entries({})
+        self.count = itertools.count()
+
+    def commit(self, *parents):
+        msg = f"tree {self.tree}\n"
+        msg += "".join(f"parent {parent}\n" for parent in parents)
+        msg += f"\n{next(self.count)}\n"
+        return data.hash_object(msg.encode(), "commit")
+
+    def history(self, count, parent=None):
+        commits = []
+        for _ in range(count):
+            parent = self.commit(*[parent] if parent else [])
+            commits.append(parent)
+        return commits
+
+    def test_walk_stops_near_the_base(self):
+        commits = self.history(500)
+        with mock.patch.object(base, "get_commit_meta",
+                               wraps=base.get_commit_meta) as meta:
+            self.assertEqual(base.get_merge_bases(commits[-1], commits[-6]),
+                             [commits[-6]])
+        # Both sides only go a few commits past the base
+        self.assertLess(meta.call_count, 30)
+
+    def test_branches(self):
+        trunk = self.history(20)
+        left = self.history(5, trunk[-1])
+        right = self.history(8, trunk[-1])
+        self.assertEqual(base.get_merge_bases(left[-1], right[-1]),
+                         [trunk[-1]])
+        self.assertTrue(base.is_ancestor_of(left[-1], trunk[3]))
+        self.assertFalse(base.is_ancestor_of(left[-1], right[0]))
+
+    def test_criss_cross(self):
+        a, b = self.history(2)
+        c = self.commit(a)
+        left = self.commit(b, c)
+        right = self.commit(c, b)
+        self.assertEqual(set(base.get_merge_bases(left, right)), {b, c})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import tempfile
+import unittest
+
+from xsgit import base, data, diff
+
+
+class MergeTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(data.change_git_dir(tmp))
+        data.init()
+
+    def tree(self, files):
+        """
+        Store a dict of name to content, or to a dict for a subtree
+        """
+        return base.write_tree_entries({
+            name: ("tree", self.tree(value)) if isinstance(value, dict)
+            else ("blob", data.hash_object(value))
+            for name, value in files.items()})
+
+    def entries(self, oid):
+        return {name: (type_, self.entries(oid_) if type_ == "tree"
+                       else data.get_object(oid_))
+                for name, (type_, oid_) in base.get_tree_entries(oid).items()}
+
+    def test_file_against_directory(self):
+        t_base = self.tree({"d": {"a": b"1\n"}, "b": b"x\n"})
+        t_HEAD = self.tree({"d": {"a": b"2\n"}, "b": b"x\n"})
+        t_other = self.tree({"d": {"a": {"f": b"3\n"}}, "b": b"x\n"})
+        conflicts = []
+        merged = diff.merge_tree_oids(t_base, t_HEAD, t_other, conflicts)
+
+        self.assertEqual(conflicts, ["d/a"])
+        self.assertEqual(self.entries(merged), {
+            "b": ("blob", b"x\n"),
+            "d": ("tree", {"a": ("blob", b"2\n"),
+                           "a~MERGE_HEAD": ("tree", {"f": ("blob", b"3\n")})}),
+        })
+
+    def test_directories_added_over_a_file(self):
+        t_base = self.tree({"a": b"1\n"})
+        t_HEAD = self.tree({"a": {"f": b"2\n"}})
+        t_other = self.tree({"a": {"g": b"3\n"}})
+        conflicts = []
+        merged = diff.merge_tree_oids(t_base, t_HEAD, t_other, conflicts)
+
+        self.assertEqual(conflicts, [])
+        self.assertEqual(self.entries(merged), {
+            "a": ("tree", {"f": ("blob", b"2\n"), "g": ("blob", b"3\n")}),
+        })
+
+
+class UnifiedDiffTest(unittest.TestCase):
+
+    def test_changes_slide_down_like_git(self):
+        ori = b"void f(void)\n{\n\tx++;\n}\n"
+        dest = (b"void f(void)\n{\n\ty--;\n\tx++;\n\n}\n"
+                b"\nvoid f(void)\n{\n\tx++;\n}\n")
+        # As git diff --no-indent-heuristic and diff -u print it
+        self.assertEqual(diff.unified_diff(ori, dest, "a/f.c", "b/f.c"), (
+            b"--- a/f.c\n"
+            b"+++ b/f.c\n"
+            b"@@ -1,4 +1,11 @@\n"
+            b" void f(void)\n"
+            b" {\n"
+            b"+\ty--;\n"
+            b"+\tx++;\n"
+            b"+\n"
+            b"+}\n"
+            b"+\n"
+            b"+void f(void)\n"
+            b"+{\n"
+            b" \tx++;\n"
+            b" }\n"))
+
+
+class MergeContentsTest(unittest.TestCase):
+
+    def test_adjacent_changes_conflict(self):
+        result = diff.merge_contents(b"1\n2\n3\n4\n", b"1\nA\n3\n4\n",
+                                     b"1\n2\nB\n4\n")
+        # The same region diff3 -m and git merge-file mark
+        self.assertEqual(result.content, (
+            b"1\n"
+            b"<<<<<<< HEAD\n"
+            b"A\n"
+            b"3\n"
+            b"||||||| BASE\n"
+            b"2\n"
+            b"3\n"
+            b"=======\n"
+            b"2\n"
+            b"B\n"
+            b">>>>>>> MERGE_HEAD\n"
+            b"4\n"))
+        self.assertEqual(result.conflicts, [
+            diff.Conflict(1, 11, b"A\n3\n", b"2\n3\n", b"2\nB\n")])
+
+    def test_changes_apart_merge(self):
+        result = diff.merge_contents(b"1\n2\n3\n4\n", b"1\nA\n3\n4\n",
+                                     b"1\n2\n3\nB\n")
+        self.assertEqual(result.content, b"1\nA\n3\nB\n")
+        self.assertEqual(result.conflicts, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
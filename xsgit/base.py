@@ -1,10 +1,13 @@
+import heapq
 import os
 import itertools
 import operator
 import string
+import time
 
-from collections import deque, namedtuple
-from . import data, diff
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from . import bitmap, data, diff, graph, trace
 
 
 def init():
@@ -20,35 +23,61 @@ def write_tree():
     """
     Write into tree and set up the recursive structure
     """
+    return _build_tree(data.read_index(), write=True)[0]
+
+
+def hash_tree(tree):
+    """
+    Hash a flat dict of path to oid (the index, the working tree) into tree
+    objects without writing them
+    Return the root oid and the entries of every tree by oid, for the tree
+    diff to use in place of stored trees
+    """
+    return _build_tree(tree, write=False)
+
+
+def _build_tree(index, write):
+    """
+    Turn the flat paths into nested tree objects, return root oid and trees
+    """
     index_as_tree = {}
-    with data.get_index() as index:
-        for path, oid in index.items():
-            path = path.split("/")
-            dirpath, filename = path[:-1], path[-1]
+    for path, oid in index.items():
+        path = path.split("/")
+        dirpath, filename = path[:-1], path[-1]
+
+        curr = index_as_tree
 
-            curr = index_as_tree
+        for dirname in dirpath:
+            curr = curr.setdefault(dirname, {})
+        curr[filename] = oid
 
-            for dirname in dirpath:
-                curr = curr.setdefault(dirname, {})
-            curr[filename] = oid
+    trees = {}
 
     def write_tree_recursive(tree_dict):
-        entries = []
+        entries = {}
         for name, value in tree_dict.items():
             if isinstance(value, dict):
-                type_ = "tree"
-                oid = write_tree_recursive(value)
+                entries[name] = ("tree", write_tree_recursive(value))
             else:
-                type_ = "blob"
-                oid = value
+                entries[name] = ("blob", value)
 
-            entries.append((name, oid, type_))
+        tree_oid = write_tree_entries(entries, write)
+        trees[tree_oid] = entries
+        return tree_oid
+
+    return write_tree_recursive(index_as_tree), trees
 
-        tree = "".join(f"{type_} {oid} {name}\n"
-                       for name, oid, type_ in sorted(entries))
-        return data.hash_object(tree.encode(), "tree")
 
-    return write_tree_recursive(index_as_tree)
+def write_tree_entries(entries, write=True):
+    """
+    Store a single tree object given its dict of name to (type, oid)
+    Without write only its oid is computed
+    """
+    tree = "".join(f"{type_} {oid} {name}\n"
+                   for name, (type_, oid) in sorted(entries.items()))
+    if write:
+        return data.hash_object(tree.encode(), "tree")
+    return data.hash_data(tree.encode(), "tree")
 
 
 def _iter_tree_entries(oid):
@@ -58,11 +87,32 @@ def _iter_tree_entries(oid):
     if not oid:
         return
 
-    tree = data.get_object(oid, "tree")
+    entries = data.get_object_cache().get("tree", oid)
+    if entries is None:
+        entries = _parse_tree(oid)
+
     # Iterator that yields entry info until recursion ends in callee function
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(" ", 2)
-        yield type_, oid, name
+    yield from entries
+
+
+@trace.traced("tree parse")
+def _parse_tree(oid):
+    """
+    Read a tree object into a tuple of (type, oid, name), and cache it
+    """
+    tree = data.get_object(oid, "tree")
+    entries = tuple(tuple(entry.split(" ", 2))
+                    for entry in tree.decode().splitlines())
+    data.get_object_cache().put("tree", oid, entries, len(tree))
+    return entries
+
+
+def get_tree_entries(oid):
+    """
+    Entries of a single tree object as a dict of name to (type, oid)
+    """
+    return {name: (type_, oid_)
+            for type_, oid_, name in _iter_tree_entries(oid)}
 
 
 def get_tree(oid, base_path=""):
@@ -86,51 +136,67 @@ def get_tree(oid, base_path=""):
     return result
 
 
-def get_working_tree():
+@trace.traced("working tree")
+def get_working_tree(jobs=None):
     """
     Go through curr directory and get info form files
+    Files are only hashed, their objects are not written
     """
     result = {}
-    for root, _, fnames, in os.walk("."):
-        for fname in fnames:
-            path = os.path.relpath(f"{root}/{fname}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, "rb") as f:
-                result[path] = data.hash_object(f.read())
+    refreshed = {}
+    index = data.read_index()
+
+    # The walk feeds the workers, files are read and hashed in parallel
+    # since hashlib, zlib and file reads release the GIL
+    with ThreadPoolExecutor(get_jobs(jobs)) as pool:
+        pending = []
+        for path in _iter_working_files("."):
+            # Only rehash files whose stat data changed since staged
+            st = os.stat(path)
+            oid = index.cached_oid(path, st)
+            if oid is None:
+                future = pool.submit(data.hash_file, path, write=False)
+                pending.append((path, st, future))
+            else:
+                result[path] = oid
+
+        for path, st, future in pending:
+            oid = result[path] = future.result()
+            # Unchanged content, refresh the stat data
+            if index.get(path) == oid:
+                refreshed[path] = (oid, st)
 
+    if refreshed:
+        data.refresh_index_stats(refreshed)
     return result
 
 
-def get_index_tree():
+def get_jobs(jobs=None):
     """
-    Return index
+    Number of parallel workers: --jobs, then core.jobs, then the CPU count
     """
-    with data.get_index() as index:
-        return index
+    if not jobs:
+        jobs = int(data.get_config("core.jobs", 0)) or os.cpu_count() or 1
+    return jobs
 
 
-def _empty_curr_directory():
+def _iter_working_files(dirname):
     """
-    Clear current directory iteratively before reading a tree objct
+    Walk the directory and yield the paths of files that are not ignored
     """
-    for root, directories, files in os.walk(".", topdown=False):
-        for f in files:
-            path = os.path.relpath(f"{root}/{f}")
-
+    for root, _, fnames in os.walk(dirname):
+        for fname in fnames:
+            path = os.path.relpath(f"{root}/{fname}")
             if is_ignored(path) or not os.path.isfile(path):
                 continue
+            yield path
 
-            os.remove(path)
 
-        for directory in directories:
-            path = os.path.relpath(f"{root}/{directory}")
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                pass
+def get_index_tree():
+    """
+    Return index
+    """
+    return data.read_index()
 
 
 def read_tree(tree_oid, update_working=False):
@@ -138,38 +204,115 @@ def read_tree(tree_oid, update_working=False):
     Include indcices in tree reading
     """
     with data.get_index() as index:
-        index.clear()
-        index.update(get_tree(tree_oid))
+        changes = _update_index(index, tree_oid)
 
         if update_working:
-            _checkout_index(index)
+            _checkout_changes(index, changes)
 
 
 def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
     """
     Merge trees by writing into files
+    Return the paths that are a file on one side and a directory on the
+    other
     """
+    conflicts = []
+    merged = diff.merge_tree_oids(t_base, t_HEAD, t_other, conflicts)
+
     with data.get_index() as index:
-        index.clear()
-        index.update(diff.merge_trees(
-            get_tree(t_base),
-            get_tree(t_HEAD),
-            get_tree(t_other)
-        ))
+        changes = _update_index(index, merged)
 
-    if update_working:
-        _checkout_index(index)
+        if update_working:
+            _checkout_changes(index, changes)
+    return conflicts
 
 
-def _checkout_index(index):
+def _update_index(index, tree_oid):
     """
-    Checkout to a particular index
+    Bring the index to the tree, only the paths that differ are set
+    Return the changes as (path, oid_ori, oid_dest)
     """
-    _empty_curr_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(f"./{path}"), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(data.get_object(oid, "blob"))
+    root, trees = hash_tree(index)
+    changes = list(diff.iter_tree_diff(root, tree_oid, trees=trees))
+    for path, _, oid in changes:
+        if oid:
+            index[path] = oid
+        else:
+            del index[path]
+    return changes
+
+
+@trace.traced("working tree")
+def _checkout_changes(index, changes):
+    """
+    Update the working tree for the changed paths of the index
+    Files that didn't change keep their content and mtime, and files the
+    index doesn't track are left alone
+    """
+    # Deletions first, a removed file can make way for a directory
+    for path, _, oid in changes:
+        if not oid:
+            _remove_working_file(path)
+
+    writes = [(path, oid) for path, _, oid in changes if oid]
+
+    # Every directory exists before the first file is written, so workers
+    # never race on creating the same directory
+    for dirname in sorted({os.path.dirname(path) for path, _ in writes}):
+        if dirname:
+            _make_working_dir(dirname)
+
+    # Reading the blobs and writing the files is I/O bound, overlap it
+    with ThreadPoolExecutor(get_checkout_workers()) as pool:
+        stats = pool.map(_write_working_file, writes)
+        for (path, oid), st in zip(writes, stats):
+            index.set_entry(path, oid, st)
+
+
+def get_checkout_workers():
+    """
+    Number of files written at once: checkout.workers, then the jobs
+    """
+    return int(data.get_config("checkout.workers", 0)) or get_jobs()
+
+
+def _remove_working_file(path):
+    """
+    Remove a file and the directories it leaves empty
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        try:
+            os.removedirs(dirname)
+        except OSError:
+            pass
+
+
+def _make_working_dir(dirname):
+    """
+    Create the directory, replacing a file that is in place of it
+    """
+    parts = dirname.split("/")
+    for i in range(1, len(parts) + 1):
+        parent = "/".join(parts[:i])
+        if os.path.isfile(parent):
+            os.remove(parent)
+    os.makedirs(dirname, exist_ok=True)
+
+
+def _write_working_file(entry):
+    """
+    Write the blob of a (path, oid) to its path, return the file's stat
+    """
+    path, oid = entry
+    with open(path, "wb") as f:
+        f.write(data.get_object(oid, "blob"))
+    return os.stat(path)
 
 
 def commit(message):
@@ -196,6 +339,7 @@ def commit(message):
 
     # Set the latest commit as HEAD
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=oid))
+    update_commit_graph([oid])
 
     return oid
 
@@ -205,7 +349,7 @@ def checkout(name):
     Given an oid and get read the tree and set our HEAD to the tree
     """
     oid = get_oid(name)
-    cmt = get_commit(oid)
+    cmt = get_commit_meta(oid)
     read_tree(cmt.tree, update_working=True)
 
     if is_branch(name):
@@ -230,7 +374,8 @@ def merge(other):
     HEAD = data.get_ref("HEAD").value
     assert HEAD
     merge_base = get_merge_base(other, HEAD)
-    c_other = get_commit(other)
+    c_other = get_commit_meta(other)
+    update_commit_graph([other])
 
     # Handle fast-farward mege while can
     if merge_base == HEAD:
@@ -241,10 +386,13 @@ def merge(other):
 
     data.update_ref("MERGE_HEAD", data.RefValue(symbolic=False, value=other))
 
-    c_base = get_commit(merge_base)
-    c_HEAD = get_commit(HEAD)
-    read_tree_merged(c_base.tree, c_HEAD.tree,
-                     c_other.tree, update_working=True)
+    c_base = get_commit_meta(merge_base)
+    c_HEAD = get_commit_meta(HEAD)
+    conflicts = read_tree_merged(c_base.tree, c_HEAD.tree,
+                                 c_other.tree, update_working=True)
+    for path in conflicts:
+        print(f"CONFLICT (file/directory): {path}, MERGE_HEAD's version "
+              f"is at {path}~MERGE_HEAD")
     print("Merged in working tree\nPlease commit")
 
 
@@ -252,20 +400,112 @@ def get_merge_base(oid1, oid2):
     """
     Return the oid of the merge's base by comparing one by one
     """
-    parents1 = set(iter_commits_and_parents({oid1}))
+    bases = get_merge_bases(oid1, oid2)
+    return bases[0] if bases else None
+
+
+# Flags painted on commits while looking for merge bases
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+_RESULT = 8
+
+# Generation of commits the commit graph doesn't have, they can only be
+# descendants of commits in the graph
+GENERATION_INFINITY = float("inf")
+
+
+def get_generation(oid):
+    """
+    Generation number of a commit from the commit graph
+    """
+    cmt = graph.get_commit(oid)
+    return cmt.generation if cmt else GENERATION_INFINITY
+
+
+@trace.traced("walk")
+def get_merge_bases(oid1, oid2):
+    """
+    Return every best common ancestor of the two commits
+    Walk down from both sides at once, highest generation first, painting
+    the commits with the side they were reached from. A commit reached from
+    both is a candidate and everything below it is stale, the walk stops as
+    soon as only stale commits are left to visit
+    Commits the walk already went past are made stale at once, without a
+    commit graph nothing orders the walk and a side that got ahead of the
+    other would otherwise run down to the root
+    """
+    if oid1 == oid2:
+        return [oid1]
+
+    flags = {oid1: _PARENT1}
+    flags[oid2] = flags.get(oid2, 0) | _PARENT2
+    counter = itertools.count()
+    queue = [(-get_generation(oid), next(counter), oid)
+             for oid in (oid1, oid2)]
+    heapq.heapify(queue)
+
+    results = []
+    while any(not flags[oid] & _STALE for _, _, oid in queue):
+        _, _, oid = heapq.heappop(queue)
+        paint = flags[oid] & (_PARENT1 | _PARENT2 | _STALE)
+        if paint == _PARENT1 | _PARENT2:
+            if not flags[oid] & _RESULT:
+                flags[oid] |= _RESULT
+                results.append(oid)
+            paint |= _STALE
+            _paint_stale(oid, flags)
+
+        for parent in get_commit_meta(oid).parents:
+            if flags.get(parent, 0) & paint == paint:
+                continue
+            flags[parent] = flags.get(parent, 0) | paint
+            heapq.heappush(queue,
+                           (-get_generation(parent), next(counter), parent))
+
+    # A candidate reached again from another candidate is not a best one
+    results = [oid for oid in results if not flags[oid] & _STALE]
+    return [oid for oid in results
+            if not any(other != oid and is_ancestor_of(other, oid)
+                       for other in results)]
 
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
-            return oid
 
-    return None
+def _paint_stale(oid, flags):
+    """
+    Mark the painted commits below a candidate as stale
+    """
+    stack = [oid]
+    while stack:
+        for parent in get_commit_meta(stack.pop()).parents:
+            if parent in flags and not flags[parent] & _STALE:
+                flags[parent] |= _STALE
+                stack.append(parent)
 
 
+@trace.traced("walk")
 def is_ancestor_of(cmt, potential_ancestor):
     """
     Return boolean value of check
+    Commits with a lower generation than the ancestor can't reach it, so
+    the walk never goes below that generation
     """
-    return potential_ancestor in iter_commits_and_parents({cmt})
+    min_generation = get_generation(potential_ancestor)
+    if get_generation(cmt) < min_generation:
+        return False
+
+    stack = [cmt]
+    visited = {cmt}
+    while stack:
+        oid = stack.pop()
+        if oid == potential_ancestor:
+            return True
+        for parent in get_commit_meta(oid).parents:
+            if parent not in visited and \
+                    get_generation(parent) >= min_generation:
+                visited.add(parent)
+                stack.append(parent)
+
+    return False
 
 
 def create_tag(name, oid):
@@ -315,11 +555,15 @@ def get_branch_name():
 Commit = namedtuple("Commit", ["tree", "parents", "message"])
 
 
+@trace.traced(counter="get_commit")
 def get_commit(oid):
     """
     Iterate through the commits and return a namedtuple
     """
-    # TODO: Analyze the time complexity, if bad, use trie to optimize the performance
+    cache = data.get_object_cache()
+    cached = cache.get("commit", oid)
+    if cached is not None:
+        return cached
 
     parents = []
 
@@ -337,9 +581,53 @@ def get_commit(oid):
             assert False, f"Unknown field {key}"
 
     message = "\n".join(lines)
-    return Commit(tree=tree, parents=parents, message=message)
+    commit = Commit(tree=tree, parents=tuple(parents), message=message)
+    cache.put("commit", oid, commit, len(cmt))
+    return commit
+
+
+def get_commit_meta(oid):
+    """
+    Tree and parents of a commit, from the commit graph when it has the
+    commit, otherwise parsed from the commit object
+    """
+    return graph.get_commit(oid) or get_commit(oid)
+
 
+def write_commit_graph():
+    """
+    Add every commit reachable from the refs to the commit graph
+    """
+    _add_to_commit_graph(ref.value for _, ref in data.iter_refs())
+
+
+def update_commit_graph(oids):
+    """
+    Keep an existing commit graph up to date with new commits
+    """
+    if graph.exists():
+        _add_to_commit_graph(oids)
 
+
+def _add_to_commit_graph(oids):
+    """
+    Walk back from the commits until the graph, add what it is missing
+    """
+    commits = {}
+    stack = list(oids)
+    while stack:
+        oid = stack.pop()
+        if not oid or oid in commits or graph.get_commit(oid):
+            continue
+        cmt = get_commit(oid)
+        commits[oid] = cmt
+        stack.extend(cmt.parents)
+
+    graph.add_commits((oid, cmt.tree, cmt.parents)
+                      for oid, cmt in commits.items())
+
+
+@trace.traced("walk")
 def iter_commits_and_parents(oids):
     """
     Loop through every objet IDs
@@ -355,23 +643,37 @@ def iter_commits_and_parents(oids):
         visited.add(oid)
         yield oid
 
-        cmt = get_commit(oid)
+        cmt = get_commit_meta(oid)
         oids.extendleft(cmt.parents[:1])
         oids.extend(cmt.parents[1:])
 
 
-def iter_objects_in_commits(oids):
+@trace.traced("walk")
+def iter_objects_in_commits(oids, known=None):
     """
-
+    Yield the oids of the commits and of their trees and blobs
+    Every object comes after the objects it points to, so objects copied in
+    this order never leave a commit or tree whose content is missing
+    Objects for which known(oid) is true are taken as complete: the walk
+    stops at known commits and never reads known trees
     """
+    index = bitmap.get_index()
+    if known is None and index is not None:
+        yield from _iter_bitmap_objects(index, oids, ())
+        return
+
     visited = set()
 
+    def is_known(oid):
+        return known is not None and known(oid)
+
     def iter_objects_in_tree(oid):
         """
         Subfunction to get all oid
         """
         visited.add(oid)
-        yield oid
+        if is_known(oid):
+            return
 
         for type_, oid_, _ in _iter_tree_entries(oid):
             if oid_ not in visited:
@@ -379,13 +681,285 @@ def iter_objects_in_commits(oids):
                     yield from iter_objects_in_tree(oid_)
                 else:
                     visited.add(oid_)
-                    yield oid_
+                    if not is_known(oid_):
+                        yield oid_
+        yield oid
+
+    # Depth first through history, a commit comes once its parents are done
+    stack = [(oid, False) for oid in oids if oid]
+    while stack:
+        oid, parents_done = stack.pop()
+        if parents_done:
+            cmt = get_commit_meta(oid)
+            if cmt.tree not in visited:
+                yield from iter_objects_in_tree(cmt.tree)
+            yield oid
+            continue
+
+        if oid in visited:
+            continue
+        visited.add(oid)
+        if is_known(oid):
+            continue
+
+        stack.append((oid, True))
+        stack.extend((parent, False)
+                     for parent in get_commit_meta(oid).parents
+                     if parent not in visited)
+
+
+# Flags painted on commits while looking for the ones known_tips lack
+_WANTED = 1
+_KNOWN = 2
+
+
+@trace.traced("walk")
+def iter_new_objects(oids, known_tips):
+    """
+    Yield the objects reachable from oids but not from known_tips, every
+    object after the objects it points to
+    History is only walked down to the commits known_tips can reach, and
+    a tree only yields what differs from the trees of its commit's parents
+    """
+    index = bitmap.get_index()
+    if index is not None:
+        yield from _iter_bitmap_objects(index, oids, known_tips)
+        return
 
-    for oid in iter_commits_and_parents(oids):
+    visited = set()
+    for oid in _new_commits(oids, known_tips):
+        cmt = get_commit_meta(oid)
+        bases = [get_commit_meta(parent).tree for parent in cmt.parents]
+        yield from _iter_new_tree_objects(cmt.tree, bases, visited)
         yield oid
-        cmt = get_commit(oid)
-        if cmt.tree not in visited:
-            yield from iter_objects_in_tree(cmt.tree)
+
+
+def _new_commits(oids, known_tips):
+    """
+    Commits reachable from oids but not from known_tips, parents first
+    Both sides are walked together, highest generation first, and the walk
+    stops once only commits reachable from known_tips are left
+    """
+    oids = list(oids)
+    flags = {}
+    counter = itertools.count()
+    queue = []
+    # Entries of each commit in the queue, and how many of them are not
+    # known, there can be many known tips so the queue is never scanned
+    queued = defaultdict(int)
+    unknown = 0
+
+    def paint(oid, flag):
+        nonlocal unknown
+        old = flags.get(oid, 0)
+        flags[oid] = old | flag
+        if flag & _KNOWN and not old & _KNOWN:
+            unknown -= queued[oid]
+        heapq.heappush(queue, (-get_generation(oid), next(counter), oid))
+        queued[oid] += 1
+        if not flags[oid] & _KNOWN:
+            unknown += 1
+
+    for flag, tips in ((_WANTED, oids), (_KNOWN, known_tips)):
+        for oid in tips:
+            paint(oid, flag)
+
+    while unknown:
+        _, _, oid = heapq.heappop(queue)
+        queued[oid] -= 1
+        if not flags[oid] & _KNOWN:
+            unknown -= 1
+
+        for parent in get_commit_meta(oid).parents:
+            if flags.get(parent, 0) & flags[oid] != flags[oid]:
+                paint(parent, flags[oid])
+
+    new = {oid for oid, paint in flags.items() if paint == _WANTED}
+    return _parents_first(oids, new)
+
+
+def _parents_first(oids, commits):
+    """
+    Order the commits reachable from oids within commits, depth first so a
+    commit comes once its parents are done
+    """
+    ordered = []
+    done = set()
+    stack = [(oid, False) for oid in oids if oid in commits]
+    while stack:
+        oid, parents_done = stack.pop()
+        if parents_done:
+            ordered.append(oid)
+        elif oid not in done:
+            done.add(oid)
+            stack.append((oid, True))
+            stack.extend((parent, False)
+                         for parent in get_commit_meta(oid).parents
+                         if parent in commits and parent not in done)
+    return ordered
+
+
+def _iter_new_tree_objects(oid, bases, visited):
+    """
+    Yield the objects of a tree that the base trees at the same path don't
+    have, children first
+    Subtrees equal to one of the bases are never read
+    """
+    if oid in visited or oid in bases:
+        return
+    visited.add(oid)
+
+    base_entries = [get_tree_entries(base) for base in bases]
+    for type_, oid_, name in _iter_tree_entries(oid):
+        known = [entries[name][1] for entries in base_entries
+                 if entries.get(name, (None,))[0] == type_]
+        if type_ == "tree":
+            yield from _iter_new_tree_objects(oid_, known, visited)
+        elif oid_ not in visited and oid_ not in known:
+            visited.add(oid_)
+            yield oid_
+    yield oid
+
+
+def _iter_bitmap_objects(index, oids, known_tips):
+    """
+    Yield the objects reachable from oids but not from known_tips, every
+    object after the objects it points to, using the reachability bitmaps
+    """
+    known = _bitmap_walk(index, known_tips)
+    bits, extra = _bitmap_walk(index, oids, known)
+    for position in bitmap.iter_positions(bits & ~known[0]):
+        yield bitmap.get_oid(index, position)
+    yield from extra
+
+
+def _bitmap_walk(index, oids, known=(0, ())):
+    """
+    Return the bits of the objects reachable from oids, or from the known
+    (bits, objects) walked before, and the objects outside the bitmaps'
+    ordering that only oids reach, every object after the objects it
+    points to
+    History is walked down to the nearest bitmapped commits, then trees
+    are only read where those commits don't already reach them
+    """
+    oids = list(oids)
+    size = (index.count + 7) // 8
+    mask = bytearray(known[0].to_bytes(size, "little"))
+    known_extra = set(known[1])
+    extra = {}
+
+    def has(oid):
+        position = bitmap.find_position(index, oid)
+        if position is None:
+            return oid in extra or oid in known_extra
+        return mask[position >> 3] >> (position & 7) & 1
+
+    def add(oid):
+        position = bitmap.find_position(index, oid)
+        if position is None:
+            extra[oid] = None
+        else:
+            mask[position >> 3] |= 1 << (position & 7)
+
+    def add_tree(oid):
+        if has(oid):
+            return
+        for type_, oid_, _ in _iter_tree_entries(oid):
+            if type_ == "tree":
+                add_tree(oid_)
+            elif not has(oid_):
+                add(oid_)
+        add(oid)
+
+    # Highest generation first, so the bitmap of a commit is taken before
+    # its ancestors get walked
+    counter = itertools.count()
+    queue = [(-get_generation(oid), next(counter), oid)
+             for oid in set(oids) if oid]
+    heapq.heapify(queue)
+    walked = set()
+    while queue:
+        _, _, oid = heapq.heappop(queue)
+        if oid in walked or has(oid):
+            continue
+        bits = bitmap.get_bitmap(index, oid)
+        if bits is not None:
+            mask[:] = (int.from_bytes(mask, "little") | bits).to_bytes(
+                size, "little")
+            continue
+
+        walked.add(oid)
+        for parent in get_commit_meta(oid).parents:
+            if parent not in walked:
+                heapq.heappush(
+                    queue, (-get_generation(parent), next(counter), parent))
+
+    for oid in _parents_first(oids, walked):
+        if not has(oid):
+            add_tree(get_commit_meta(oid).tree)
+            add(oid)
+
+    return int.from_bytes(mask, "little"), list(extra)
+
+
+# Commits between two bitmaps along history, bounds the walk down to one
+_BITMAP_INTERVAL = 100
+
+
+@trace.traced("walk")
+def write_bitmaps():
+    """
+    Write reachability bitmaps over the objects the refs reach, for the
+    ref tips and every _BITMAP_INTERVAL commits of their history
+    """
+    tips = {ref.value for _, ref in data.iter_refs() if ref.value}
+    index = bitmap.new_index(list(iter_objects_in_commits(tips)))
+
+    commits = _parents_first(tips, set(iter_commits_and_parents(tips)))
+    selected = tips | set(commits[::_BITMAP_INTERVAL])
+    for oid in commits:
+        if oid in selected:
+            # Walks down to the bitmaps of the commits before it
+            index.bitmaps[oid] = _bitmap_walk(index, [oid])[0]
+
+    bitmap.write(index)
+    return len(index.bitmaps)
+
+
+def iter_reachable_objects():
+    """
+    Yield every object the refs, MERGE_HEAD and the index keep alive
+    """
+    yield from iter_objects_in_commits(
+        {ref.value for _, ref in data.iter_refs()})
+    yield from data.read_index().values()
+
+
+# Unreachable objects younger than this may still be about to be used
+_GC_GRACE = 14 * 24 * 3600
+
+
+def gc(grace=None):
+    """
+    Pack every reachable object into one pack and prune the others once
+    older than grace seconds, gc.grace by default
+    Return a summary of what was done
+    """
+    if grace is None:
+        grace = int(data.get_config("gc.grace", _GC_GRACE))
+
+    start = time.perf_counter()
+    size_before = data.object_store_size()
+    reachable = set(iter_reachable_objects())
+    pruned = data.repack_objects(reachable, grace)
+    size_after = data.object_store_size()
+    # The bitmap walks go by generation too
+    write_commit_graph()
+    bitmaps = write_bitmaps()
+
+    return {"objects": len(reachable), "pruned": pruned, "bitmaps": bitmaps,
+            "size_before": size_before, "size_after": size_after,
+            "seconds": time.perf_counter() - start}
 
 
 def get_oid(name):
@@ -404,8 +978,11 @@ def get_oid(name):
     ]
 
     for ref in potential_refs:
-        if data.get_ref(ref, deref=False).value:
+        value = data.get_ref(ref, deref=False)
+        if value.symbolic:
             return data.get_ref(ref).value
+        if value.value:
+            return value.value
 
     # Check for name to be a hashed value
     is_hex = all(c in string.hexdigits for c in name)
@@ -415,30 +992,27 @@ def get_oid(name):
     assert False, f"Unknown name {name}"
 
 
-def add(filenames):
+@trace.traced("working tree")
+def add(filenames, jobs=None):
     """
     Put file changes
     """
-    def add_file(filename):
-        filename = os.path.relpath(filename)
-        with open(filename, "rb") as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
-
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                path = os.path.relpath(f"{root}/{filename}")
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
-
-    with data.get_index() as index:
+    def iter_paths():
         for name in filenames:
             if os.path.isfile(name):
-                add_file(name)
+                yield os.path.relpath(name)
             elif os.path.isdir(name):
-                add_directory(name)
+                yield from _iter_working_files(name)
+
+    with data.get_index() as index, ThreadPoolExecutor(get_jobs(jobs)) as pool:
+        pending = []
+        for path in iter_paths():
+            st = os.stat(path)
+            if index.cached_oid(path, st) is None:
+                pending.append((path, st, pool.submit(data.hash_file, path)))
+
+        for path, st, future in pending:
+            index.set_entry(path, future.result(), st)
 
 
 def is_ignored(path):
@@ -0,0 +1,205 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from collections import namedtuple
+
+from . import data
+
+# Reachability bitmaps give, for selected commits, the set of every object
+# the commit reaches, as one bit per object over a stable ordering of the
+# object store. Sets of objects then combine with integer operations
+# instead of walking history and parsing trees:
+#
+# file: "XBMP" version object_count bitmap_count, oids[object_count] in
+#       the order of the bits, every object after the objects it points to,
+#       fanout[256] and the same oids sorted with their positions, like the
+#       index of a pack, per bitmap: position of the commit, offset and
+#       length of its zlib compressed bits in the data that follows, and a
+#       trailing sha1
+#
+# Positions are only looked up in the mapped file for the objects a
+# command meets, an index being built keeps them in memory instead
+Bitmaps = namedtuple("Bitmaps", ["count", "oids", "positions", "fanout",
+                                 "entries", "data", "bitmaps"])
+
+_HEADER = struct.Struct(">4sIII")
+_FANOUT = struct.Struct(">256I")
+_ENTRY = struct.Struct(">III")
+_VERSION = 2
+
+# Loaded bitmaps per git directory, False when the repo has none
+_indexes = {}
+
+
+def _bitmap_path():
+    """
+    The bitmaps sit with the commit graph, next to the objects
+    """
+    return f"{data.GIT_DIR}/objects/info/bitmap"
+
+
+def drop_caches():
+    """
+    Forget the loaded bitmaps, the file may have changed on disk
+    """
+    _indexes.pop(data.GIT_DIR, None)
+
+
+def get_index():
+    """
+    Return the Bitmaps of the repo, None if it has none
+    """
+    index = _indexes.get(data.GIT_DIR)
+    if index is None:
+        index = _open_index() if os.path.isfile(_bitmap_path()) else False
+        _indexes[data.GIT_DIR] = index
+    return index or None
+
+
+def _open_index():
+    """
+    Map the bitmap file and read its fanout and table of bitmaps, the
+    ordering is left in the file
+    """
+    with open(_bitmap_path(), "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, count, bitmap_count = _HEADER.unpack_from(buf)
+    assert magic == b"XBMP" and version == _VERSION, "Bad bitmap file"
+    fanout = _FANOUT.unpack_from(buf, _HEADER.size + count * 20)
+
+    start = _HEADER.size + count * 20 + _FANOUT.size + count * 24
+    data_start = start + bitmap_count * _ENTRY.size
+    entries = {}
+    for i in range(bitmap_count):
+        position, offset, length = _ENTRY.unpack_from(
+            buf, start + i * _ENTRY.size)
+        entries[_read_oid(buf, position)] = (data_start + offset, length)
+
+    # Positions found so far, None for the objects outside the ordering
+    return Bitmaps(count=count, oids=None, positions={}, fanout=fanout,
+                   entries=entries, data=buf, bitmaps={})
+
+
+def new_index(oids):
+    """
+    Bitmaps over the ordering oids, bitmaps can be added to the bitmaps
+    dict of an index that isn't on disk
+    """
+    return Bitmaps(count=len(oids), oids=oids,
+                   positions={oid: i for i, oid in enumerate(oids)},
+                   fanout=None, entries={}, data=None, bitmaps={})
+
+
+def _read_oid(buf, position):
+    start = _HEADER.size + position * 20
+    return buf[start:start + 20].hex()
+
+
+def get_oid(index, position):
+    """
+    Return the oid at a position of the ordering
+    """
+    if index.oids is not None:
+        return index.oids[position]
+    return _read_oid(index.data, position)
+
+
+def find_position(index, oid):
+    """
+    Return the position of the oid in the ordering, None if it isn't in
+    it
+    Binary searches the sorted oids of the file the first time
+    """
+    if oid in index.positions or index.oids is not None:
+        return index.positions.get(oid)
+
+    key = bytes.fromhex(oid)
+    lo = index.fanout[key[0] - 1] if key[0] else 0
+    hi = index.fanout[key[0]]
+    oids_start = _HEADER.size + index.count * 20 + _FANOUT.size
+    position = None
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = oids_start + mid * 20
+        found = index.data[pos:pos + 20]
+        if found == key:
+            pos = oids_start + index.count * 20 + mid * 4
+            position = struct.unpack_from(">I", index.data, pos)[0]
+            break
+        if found < key:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    index.positions[oid] = position
+    return position
+
+
+def get_bitmap(index, oid):
+    """
+    Return the bits of the objects oid reaches, None if it has no bitmap
+    """
+    bits = index.bitmaps.get(oid)
+    if bits is None and oid in index.entries:
+        start, length = index.entries[oid]
+        bits = int.from_bytes(
+            zlib.decompress(index.data[start:start + length]), "little")
+        index.bitmaps[oid] = bits
+    return bits
+
+
+def iter_positions(bits):
+    """
+    Yield the positions of the set bits, lowest first
+    """
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(raw):
+        while byte:
+            low = byte & -byte
+            yield i * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+def write(index):
+    """
+    Write the ordering and the bitmaps of an index as the repo's bitmaps
+    """
+    entries = []
+    blobs = []
+    offset = 0
+    for oid in sorted(index.bitmaps, key=index.positions.get):
+        bits = index.bitmaps[oid]
+        blob = zlib.compress(
+            bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+        entries.append(_ENTRY.pack(index.positions[oid], offset, len(blob)))
+        blobs.append(blob)
+        offset += len(blob)
+
+    ordered = sorted(range(index.count), key=index.oids.__getitem__)
+    fanout = [0] * 256
+    for oid in index.oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    out = bytearray(_HEADER.pack(b"XBMP", _VERSION, index.count,
+                                 len(entries)))
+    out += b"".join(bytes.fromhex(oid) for oid in index.oids)
+    out += _FANOUT.pack(*fanout)
+    out += b"".join(bytes.fromhex(index.oids[i]) for i in ordered)
+    out += b"".join(struct.pack(">I", i) for i in ordered)
+    out += b"".join(entries)
+    out += b"".join(blobs)
+    out += hashlib.sha1(out).digest()
+
+    os.makedirs(os.path.dirname(_bitmap_path()), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(_bitmap_path()),
+                                     delete=False) as f:
+        f.write(out)
+    os.chmod(f.name, 0o444)
+    os.replace(f.name, _bitmap_path())
+    drop_caches()
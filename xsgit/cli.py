@@ -4,16 +4,43 @@ import textwrap
 import sys
 import subprocess
 
-from . import base, data, diff, remote
+from . import base, data, diff, remote, trace
 
 
 def main():
     """
     Call and run the functions for parsing arguments
     """
+    # Tracing starts before the arguments are parsed, as oids in them are
+    # resolved while parsing
+    options = _trace_options().parse_known_args()[0]
+    traced = os.environ.get("XSGIT_TRACE", "").lower() not in ("", "0",
+                                                               "false")
+    if options.trace or options.trace_file or traced:
+        trace.enable(options.trace_file or
+                     os.environ.get("XSGIT_TRACE_FILE"))
+
     with data.change_git_dir("."):
         args = parse_args()
-        args.func(args)
+        try:
+            args.func(args)
+        finally:
+            if trace.is_enabled():
+                cache = data.get_object_cache().stats()
+                trace.report({"object cache hits": cache["hits"],
+                              "object cache misses": cache["misses"]})
+
+
+def _trace_options():
+    """
+    Options of every command, for tracing where the time goes
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--trace", action="store_true",
+                        help="print where the time went on stderr")
+    parser.add_argument("--trace-file",
+                        help="also write a Chrome trace event JSON file")
+    return parser
 
 
 def parse_args():
@@ -39,97 +66,158 @@ def parse_args():
         17. show
         18. status
         19. merge-base
-    """
-    parser = argparse.ArgumentParser()
+        20. migrate-objects
+        21. repack
+        22. config
+        23. commit-graph
+        24. pack-refs
+        25. upload-pack
+        26. receive-pack
+        27. daemon
+        28. gc
+    """
+    # The trace options go before or after the command
+    common = [_trace_options()]
+    parser = argparse.ArgumentParser(parents=common)
 
     commands = parser.add_subparsers(dest="command")
     commands.required = True
 
     oid = base.get_oid
 
-    init_parser = commands.add_parser("init")
+    init_parser = commands.add_parser("init", parents=common)
     init_parser.set_defaults(func=init)
 
-    hash_object_parser = commands.add_parser("hash-object")
+    hash_object_parser = commands.add_parser("hash-object", parents=common)
     hash_object_parser.set_defaults(func=hash_object)
     hash_object_parser.add_argument("file")
 
-    cat_file_parser = commands.add_parser("cat-file")
+    cat_file_parser = commands.add_parser("cat-file", parents=common)
     cat_file_parser.set_defaults(func=cat_file)
     cat_file_parser.add_argument("object", type=oid)
 
-    write_tree_parser = commands.add_parser("write-tree")
+    write_tree_parser = commands.add_parser("write-tree", parents=common)
     write_tree_parser.set_defaults(func=write_tree)
 
-    read_tree_parser = commands.add_parser("read-tree")
+    read_tree_parser = commands.add_parser("read-tree", parents=common)
     read_tree_parser.set_defaults(func=read_tree)
     read_tree_parser.add_argument("tree", type=oid)
+    read_tree_parser.add_argument("-u", "--update", action="store_true")
 
-    commit_parser = commands.add_parser("commit")
+    commit_parser = commands.add_parser("commit", parents=common)
     commit_parser.set_defaults(func=commit)
     commit_parser.add_argument("-m", "--message", required=True)
 
-    log_parser = commands.add_parser("log")
+    log_parser = commands.add_parser("log", parents=common)
     log_parser.set_defaults(func=log)
     log_parser.add_argument("oid", default="@", type=oid, nargs="?")
 
-    show_parser = commands.add_parser("show")
+    show_parser = commands.add_parser("show", parents=common)
     show_parser.set_defaults(func=show)
     show_parser.add_argument("oid", default="@", type=oid, nargs="?")
 
-    diff_parser = commands.add_parser("diff")
+    diff_parser = commands.add_parser("diff", parents=common)
     # use underscore to differentiate from python built in diff
     diff_parser.set_defaults(func=_diff)
     diff_parser.add_argument("--cached", action="store_true")
     diff_parser.add_argument("commit", nargs="?")
+    diff_parser.add_argument("-j", "--jobs", type=int)
 
-    checkout_parser = commands.add_parser("checkout")
+    checkout_parser = commands.add_parser("checkout", parents=common)
     checkout_parser.set_defaults(func=checkout)
     checkout_parser.add_argument("commit")
 
-    tag_parser = commands.add_parser("tag")
+    tag_parser = commands.add_parser("tag", parents=common)
     tag_parser.set_defaults(func=tag)
     tag_parser.add_argument("name")
     tag_parser.add_argument("oid", default="@", type=oid, nargs="?")
 
     # Graphical visualization thingy
-    k_parser = commands.add_parser("k")
+    k_parser = commands.add_parser("k", parents=common)
     k_parser.set_defaults(func=k)
 
-    branch_parser = commands.add_parser("branch")
+    branch_parser = commands.add_parser("branch", parents=common)
     branch_parser.set_defaults(func=branch)
     branch_parser.add_argument("name", nargs="?")
     branch_parser.add_argument("starting", default="@", type=oid, nargs="?")
 
-    status_parser = commands.add_parser("status")
+    status_parser = commands.add_parser("status", parents=common)
     status_parser.set_defaults(func=status)
+    status_parser.add_argument("-j", "--jobs", type=int)
 
-    reset_parser = commands.add_parser("reset")
+    reset_parser = commands.add_parser("reset", parents=common)
     reset_parser.set_defaults(func=reset)
     reset_parser.add_argument("commit", type=oid)
 
-    merge_parser = commands.add_parser("merge")
+    merge_parser = commands.add_parser("merge", parents=common)
     merge_parser.set_defaults(func=merge)
     merge_parser.add_argument("commit", type=oid)
 
     # Return the common ancestor of two commits
-    merge_base_parser = commands.add_parser("merge-base")
+    merge_base_parser = commands.add_parser("merge-base", parents=common)
     merge_base_parser.set_defaults(func=merge_base)
     merge_base_parser.add_argument("commit1", type=oid)
     merge_base_parser.add_argument("commit2", type=oid)
+    merge_base_parser.add_argument("--all", action="store_true")
 
-    fetch_parser = commands.add_parser("fetch")
+    fetch_parser = commands.add_parser("fetch", parents=common)
     fetch_parser.set_defaults(func=fetch)
     fetch_parser.add_argument("remote")
 
-    push_parser = commands.add_parser("push")
+    push_parser = commands.add_parser("push", parents=common)
     push_parser.set_defaults(func=push)
     push_parser.add_argument("remote")
     push_parser.add_argument("branch")
 
-    add_parser = commands.add_parser("add")
+    add_parser = commands.add_parser("add", parents=common)
     add_parser.set_defaults(func=add)
     add_parser.add_argument("files", nargs="+")
+    add_parser.add_argument("-j", "--jobs", type=int)
+
+    # Move objects of the old flat layout into fanout directories
+    migrate_objects_parser = commands.add_parser("migrate-objects",
+                                                 parents=common)
+    migrate_objects_parser.set_defaults(func=migrate_objects)
+
+    repack_parser = commands.add_parser("repack", parents=common)
+    repack_parser.set_defaults(func=repack)
+    # Also merge the existing packs into one
+    repack_parser.add_argument("-a", "--all", action="store_true")
+
+    config_parser = commands.add_parser("config", parents=common)
+    config_parser.set_defaults(func=config)
+    config_parser.add_argument("name")
+    config_parser.add_argument("value", nargs="?")
+
+    commit_graph_parser = commands.add_parser("commit-graph",
+                                              parents=common)
+    commit_graph_parser.set_defaults(func=commit_graph)
+    commit_graph_parser.add_argument("action", choices=["write"])
+
+    pack_refs_parser = commands.add_parser("pack-refs", parents=common)
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    # Server side of fetch and push, speaking on stdin and stdout
+    upload_pack_parser = commands.add_parser("upload-pack", parents=common)
+    upload_pack_parser.set_defaults(func=upload_pack)
+    upload_pack_parser.add_argument("repo")
+
+    receive_pack_parser = commands.add_parser("receive-pack",
+                                              parents=common)
+    receive_pack_parser.set_defaults(func=receive_pack)
+    receive_pack_parser.add_argument("repo")
+
+    daemon_parser = commands.add_parser("daemon", parents=common)
+    daemon_parser.set_defaults(func=daemon)
+    daemon_parser.add_argument("--host", default="127.0.0.1")
+    daemon_parser.add_argument("--port", type=int,
+                               default=remote.DEFAULT_PORT)
+    daemon_parser.add_argument("--base-path", default=".")
+
+    gc_parser = commands.add_parser("gc", parents=common)
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument("--grace", type=int,
+                           help="seconds before unreachable objects go")
 
     return parser.parse_args()
 
@@ -149,8 +237,7 @@ def hash_object(args):
     """
     Perform file read and pass to hash_object function in data.py
     """
-    with open(args.file, "rb") as f:
-        print(data.hash_object(f.read()))
+    print(data.hash_file(args.file))
 
 
 def cat_file(args):
@@ -174,7 +261,7 @@ def read_tree(args):
     """
     Take in the object type and extract the encrypted data inside
     """
-    base.read_tree(args.tree)
+    base.read_tree(args.tree, update_working=args.update)
 
 
 def commit(args):
@@ -216,11 +303,10 @@ def show(args):
     cmt = base.get_commit(args.oid)
     parent_tree = None
     if cmt.parents:
-        parent_tree = base.get_commit(cmt.parents[0]).tree
+        parent_tree = base.get_commit_meta(cmt.parents[0]).tree
 
     _print_commit(args.oid, cmt)
-    result = diff.diff_trees(base.get_tree(
-        parent_tree), base.get_tree(cmt.tree))
+    result = diff.diff_trees(parent_tree, cmt.tree)
 
     sys.stdout.flush()
     sys.stdout.buffer.write(result)
@@ -236,20 +322,20 @@ def _diff(args):
 
     if args.commit:
         # Provided commit hash
-        tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+        tree_from = oid and base.get_commit_meta(oid).tree
 
     if args.cached:
         # If no commit, set from HEAD
         tree_to = base.get_index_tree()
         if not args.commit:
             oid = base.get_oid("@")
-            tree_from = base.get_index_tree(oid and base.get_commit(oid).tree)
+            tree_from = oid and base.get_commit_meta(oid).tree
     else:
-        tree_to = base.get_working_tree()
+        tree_to = base.get_working_tree(args.jobs)
         if not args.commit:
             tree_from = base.get_index_tree()
 
-    result = diff.diff_trees(tree_from, tree_to)
+    result = diff.diff_trees(tree_from, tree_to, working=not args.cached)
     sys.stdout.flush()
     sys.stdout.buffer.write(result)
 
@@ -297,7 +383,7 @@ def k(args):
             oids.add(ref.value)
 
     for oid in base.iter_commits_and_parents(oids):
-        cmt = base.get_commit(oid)
+        cmt = base.get_commit_meta(oid)
         dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
 
         for parent in cmt.parents:
@@ -334,17 +420,17 @@ def status(args):
         print(f"Merging with {MERGE_HEAD[:10]}")
 
     print("\nChanges to be commited:\n")
-    HEAD_tree = HEAD and base.get_commit(HEAD).tree
+    HEAD_tree = HEAD and base.get_commit_meta(HEAD).tree
+    index_tree = base.get_index_tree()
 
-    for path, action in diff.iter_changed_files(base.get_tree(HEAD_tree),
-                                                base.get_index_tree()):
+    for path, action in diff.iter_changed_files(HEAD_tree, index_tree):
         # Formatting the action
         print(f"{action:>12}: {path}")
 
     print("\nChanges not staged for commit:\n")
 
-    for path, action in diff.iter_changed_files(base.get_index_tree(),
-                                                base.get_working_tree()):
+    working_tree = base.get_working_tree(args.jobs)
+    for path, action in diff.iter_changed_files(index_tree, working_tree):
         print(f"{action:>12}: {path}")
 
 
@@ -366,7 +452,11 @@ def merge_base(args):
     """
     Helper function to check merge base of two commits
     """
-    print(base.get_merge_base(args.commit1, args.commit2))
+    if args.all:
+        for oid in base.get_merge_bases(args.commit1, args.commit2):
+            print(oid)
+    else:
+        print(base.get_merge_base(args.commit1, args.commit2))
 
 
 def fetch(args):
@@ -387,4 +477,87 @@ def add(args):
     """
     Helper function that directs to add
     """
-    base.add(args.files)
+    base.add(args.files, args.jobs)
+
+
+def migrate_objects(args):
+    """
+    Helper function for moving objects into the fanout layout
+    """
+    print(f"Migrated {data.migrate_objects()} objects")
+
+
+def repack(args):
+    """
+    Helper function for packing the loose objects
+    """
+    if args.all:
+        oids = set(data.iter_loose_objects()) | set(data.iter_packed_objects())
+        data.repack_objects(oids, grace=0)
+        print(f"Packed {len(oids)} objects")
+    else:
+        print(f"Packed {data.pack_loose_objects()} objects")
+
+
+def config(args):
+    """
+    Print a config value, or set it when a value is given
+    """
+    if args.value is None:
+        value = data.get_config(args.name)
+        if value is not None:
+            print(value)
+    else:
+        data.set_config(args.name, args.value)
+
+
+def commit_graph(args):
+    """
+    Helper function for writing the commit graph
+    """
+    base.write_commit_graph()
+
+
+def pack_refs(args):
+    """
+    Helper function for packing the loose refs
+    """
+    print(f"Packed {data.pack_refs()} refs")
+
+
+def upload_pack(args):
+    """
+    Helper function for serving a fetch on stdio
+    """
+    # The server pulls in asyncio, only the commands serving import it
+    from . import server
+    server.serve_stdio("upload-pack", args.repo)
+
+
+def receive_pack(args):
+    """
+    Helper function for serving a push on stdio
+    """
+    from . import server
+    server.serve_stdio("receive-pack", args.repo)
+
+
+def daemon(args):
+    """
+    Helper function for serving the repos under a directory over TCP
+    """
+    from . import server
+    server.serve_tcp(args.host, args.port, args.base_path)
+
+
+def gc(args):
+    """
+    Helper function for collecting the garbage, with a report
+    """
+    stats = base.gc(args.grace)
+    reclaimed = stats["size_before"] - stats["size_after"]
+    print(f"Packed {stats['objects']} objects, "
+          f"pruned {stats['pruned']} unreachable objects, "
+          f"wrote {stats['bitmaps']} bitmaps")
+    print(f"Reclaimed {reclaimed} bytes ({stats['size_before']} -> "
+          f"{stats['size_after']}) in {stats['seconds']:.2f}s")
@@ -1,11 +1,20 @@
+import configparser
 import hashlib
+import itertools
+import mmap
 import os
-import shutil
 import json
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 
+from . import trace
+
 GIT_DIR = None
 
 
@@ -29,13 +38,84 @@ def init():
     os.makedirs(f"{GIT_DIR}/objects")
 
 
+def get_config(name, default=None):
+    """
+    Read a "section.key" value from the repo's config file
+    """
+    section, key = name.split(".", 1)
+    config = configparser.ConfigParser()
+    config.read(f"{GIT_DIR}/config")
+    return config.get(section, key, fallback=default)
+
+
+def set_config(name, value):
+    """
+    Write a "section.key" value into the repo's config file
+    """
+    section, key = name.split(".", 1)
+    config = configparser.ConfigParser()
+    config.read(f"{GIT_DIR}/config")
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, key, str(value))
+
+    with open(f"{GIT_DIR}/config", "w") as f:
+        config.write(f)
+
+
+# Seconds a writer waits for another one to let go of a lock
+_LOCK_TIMEOUT = 10
+
+
+@contextmanager
+def lock_file(path):
+    """
+    Hold path.lock while the block runs, waiting for other writers to let
+    go of it, and yield it open to write the new content of path
+    What the block wrote replaces path at the end, readers only ever see
+    the old or the new content. Nothing written leaves path as it was
+    """
+    lock_path = f"{path}.lock"
+    deadline = time.monotonic() + _LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o644)
+            break
+        except FileExistsError:
+            assert time.monotonic() < deadline, f"Unable to lock {path}"
+            time.sleep(0.01)
+
+    replaced = False
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+            written = f.tell() > 0
+        if written:
+            os.replace(lock_path, path)
+            replaced = True
+    finally:
+        # Once replaced, the lock may already be another writer's
+        if not replaced:
+            os.remove(lock_path)
+
+
 # Abstraction for value for easier manipulation
 RefValue = namedtuple("RefValue", ["symbolic", "value"])
 
+# Resolved refs per git directory, loose ref updates clear it
+_refs = {}
+
+# Mapped packed-refs file per git directory, b"" when there is none
+_packed_refs = {}
+
 
-def update_ref(ref, value, deref=True):
+@trace.traced("ref I/O")
+def update_ref(ref, value, deref=True, old=None):
     """
     Set the latest commit blob as the HEAD to link history commits
+    With old, the ref is only moved if it still points to old, "" for a
+    ref that must not exist yet, return whether it was moved
     """
     ref = _get_ref_internal(ref, deref)[0]
 
@@ -49,10 +129,19 @@ def update_ref(ref, value, deref=True):
     ref_path = f"{GIT_DIR}/{ref}"
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
 
-    with open(ref_path, "w") as f:
+    with lock_file(ref_path) as f:
+        if old is not None:
+            # Read again under the lock, another process may have moved it
+            _packed_refs.pop(GIT_DIR, None)
+            if (_resolve_ref(ref, deref=False)[1].value or "") != old:
+                _refs.pop(GIT_DIR, None)
+                return False
         f.write(value)
+    _refs.pop(GIT_DIR, None)
+    return True
 
 
+@trace.traced(counter="get_ref")
 def get_ref(ref, deref=True):
     """
     A recursive function that find the ref which has the oid and value
@@ -60,17 +149,39 @@ def get_ref(ref, deref=True):
     return _get_ref_internal(ref, deref)[1]
 
 
+@trace.traced("ref I/O")
 def delete_ref(ref, deref=True):
     """
-    Delete existing reference
+    Delete existing reference, loose or packed
     """
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f"{GIT_DIR}/{ref}")
+    try:
+        os.remove(f"{GIT_DIR}/{ref}")
+    except FileNotFoundError:
+        assert _find_packed_ref(ref), f"Unknown ref {ref}"
+
+    if _find_packed_ref(ref):
+        _write_packed_refs({name: oid for name, oid in _iter_packed_refs()
+                            if name != ref})
+    _refs.pop(GIT_DIR, None)
 
 
 def _get_ref_internal(ref, deref):
     """
     Return data in HEAD file if available
+    Resolved once per process, until a ref is updated
+    """
+    refs = _refs.setdefault(GIT_DIR, {})
+    key = (ref, deref)
+    if key not in refs:
+        refs[key] = _resolve_ref(ref, deref)
+    return refs[key]
+
+
+@trace.traced("ref I/O")
+def _resolve_ref(ref, deref):
+    """
+    Read the loose ref, fall back to packed-refs
     """
     ref_path = f"{GIT_DIR}/{ref}"
     value = None
@@ -78,6 +189,8 @@ def _get_ref_internal(ref, deref):
     if os.path.isfile(ref_path):
         with open(ref_path) as f:
             value = f.read().strip()
+    else:
+        value = _find_packed_ref(ref)
 
     symbolic = bool(value) and value.startswith("ref:")
     if symbolic:
@@ -88,39 +201,362 @@ def _get_ref_internal(ref, deref):
     return ref, RefValue(symbolic=symbolic, value=value)
 
 
+@trace.traced("ref I/O")
 def iter_refs(prefix="", deref=True):
     """
     Go through every ref and display according to path
+    Loose refs take precedence over the packed ones
     """
     refs = ["HEAD", "MERGE_HEAD"]
-    for root, _, fnames in os.walk(f"{GIT_DIR}/refs/"):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f"{root}/{name}" for name in fnames)
+
+    # Only walk the directory the prefix can be in
+    if prefix.startswith("refs/"):
+        top = os.path.dirname(prefix)
+    else:
+        top = "refs" if "refs/".startswith(prefix) else None
+
+    loose = set()
+    if top is not None:
+        for root, _, fnames in os.walk(f"{GIT_DIR}/{top}"):
+            root = os.path.relpath(root, GIT_DIR)
+            loose.update(f"{root}/{name}" for name in fnames
+                         if not name.endswith(".lock"))
+
+    packed = {name: oid for name, oid in _iter_packed_refs(prefix)
+              if name not in loose}
+    refs.extend(sorted(loose.union(packed)))
 
     for refname in refs:
         if not refname.startswith(prefix):
             continue
+        if refname in packed:
+            yield refname, RefValue(symbolic=False, value=packed[refname])
+            continue
         ref = get_ref(refname, deref=deref)
         if ref.value:
             yield refname, ref
 
 
+def drop_caches():
+    """
+    Forget the refs and packs read from the repo, so a long running process
+    sees what other processes changed since
+    """
+    _refs.pop(GIT_DIR, None)
+    _packed_refs.pop(GIT_DIR, None)
+    _packs.pop(GIT_DIR, None)
+
+
+def _get_packed_refs():
+    """
+    Map the packed-refs file, lines of "oid refname" sorted by refname
+    """
+    buf = _packed_refs.get(GIT_DIR)
+    if buf is None:
+        buf = b""
+        path = f"{GIT_DIR}/packed-refs"
+        if os.path.isfile(path) and os.path.getsize(path):
+            buf = _map_file(path)
+        _packed_refs[GIT_DIR] = buf
+    return buf
+
+
+def _packed_ref_at(buf, pos):
+    """
+    Return start, end, name and oid of the packed ref line around pos
+    """
+    start = buf.rfind(b"\n", 0, pos) + 1
+    end = buf.find(b"\n", start)
+    if end < 0:
+        end = len(buf)
+    return start, end, buf[start + 41:end], buf[start:start + 40]
+
+
+def _seek_packed_ref(buf, key):
+    """
+    Binary search the first line whose refname is not less than key
+    """
+    lo, hi = 0, len(buf)
+    while lo < hi:
+        start, end, name, _ = _packed_ref_at(buf, (lo + hi) // 2)
+        if name < key:
+            lo = end + 1
+        else:
+            hi = start
+    return lo
+
+
+def _find_packed_ref(ref):
+    """
+    Oid of a ref in packed-refs, None if it isn't packed
+    """
+    buf = _get_packed_refs()
+    key = ref.encode()
+    pos = _seek_packed_ref(buf, key)
+    if pos < len(buf):
+        _, _, name, oid = _packed_ref_at(buf, pos)
+        if name == key:
+            return oid.decode()
+    return None
+
+
+def _iter_packed_refs(prefix=""):
+    """
+    Yield (refname, oid) of the packed refs starting with prefix
+    """
+    buf = _get_packed_refs()
+    key = prefix.encode()
+    pos = _seek_packed_ref(buf, key)
+    while pos < len(buf):
+        _, end, name, oid = _packed_ref_at(buf, pos)
+        if not name.startswith(key):
+            break
+        yield name.decode(), oid.decode()
+        pos = end + 1
+
+
+def _write_packed_refs(refs):
+    """
+    Atomically replace packed-refs with the {refname: oid}
+    """
+    with tempfile.NamedTemporaryFile("w", dir=GIT_DIR, prefix="packed-refs",
+                                     delete=False) as f:
+        f.write("".join(f"{refs[name]} {name}\n" for name in sorted(refs)))
+    os.replace(f.name, f"{GIT_DIR}/packed-refs")
+    _packed_refs.pop(GIT_DIR, None)
+
+
+@trace.traced("ref I/O")
+def pack_refs():
+    """
+    Move the loose refs under refs/ into packed-refs
+    Symbolic refs stay loose, return the number of refs packed
+    """
+    refs = dict(_iter_packed_refs())
+    loose = {}
+    for root, _, fnames in os.walk(f"{GIT_DIR}/refs"):
+        root = os.path.relpath(root, GIT_DIR)
+        for name in fnames:
+            if name.endswith(".lock"):
+                continue
+            refname = f"{root}/{name}"
+            ref = get_ref(refname, deref=False)
+            if ref.value and not ref.symbolic:
+                loose[refname] = ref.value
+
+    refs.update(loose)
+    _write_packed_refs(refs)
+
+    for refname in loose:
+        os.remove(f"{GIT_DIR}/{refname}")
+    _refs.pop(GIT_DIR, None)
+    return len(loose)
+
+
+# Stat data of a working tree file at the time its oid was staged
+IndexStat = namedtuple("IndexStat", ["ctime", "mtime", "size", "ino", "mode"])
+
+# Binary index: "XIDX" version count, then per entry sorted by path:
+#               ctime mtime size ino mode oid path length path
+#               and a trailing sha1 of everything before it
+_INDEX_HEADER = struct.Struct(">4sII")
+_INDEX_ENTRY = struct.Struct(">qqQQI20sH")
+_INDEX_VERSION = 1
+
+
+def stat_of(st):
+    """
+    Keep the fields of os.stat that tell a file was changed
+    """
+    return IndexStat(ctime=st.st_ctime_ns, mtime=st.st_mtime_ns,
+                     size=st.st_size, ino=st.st_ino, mode=st.st_mode)
+
+
+class Index(dict):
+    """
+    Dict of path to staged oid
+    Also remembers the stat data of the file each oid was hashed from, a
+    path loses its stat data as soon as its oid changes
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {}
+        # mtime of the index file when it was read
+        self.timestamp = None
+        # Only a modified index is written back
+        self.modified = False
+
+    def __setitem__(self, path, oid):
+        if self.get(path) != oid:
+            self.stats.pop(path, None)
+            self.modified = True
+        super().__setitem__(path, oid)
+
+    def __delitem__(self, path):
+        self.stats.pop(path, None)
+        self.modified = True
+        super().__delitem__(path)
+
+    def pop(self, path, *default):
+        self.stats.pop(path, None)
+        self.modified = self.modified or path in self
+        return super().pop(path, *default)
+
+    def clear(self):
+        self.stats.clear()
+        self.modified = self.modified or bool(self)
+        super().clear()
+
+    def update(self, *args, **kwargs):
+        for path, oid in dict(*args, **kwargs).items():
+            self[path] = oid
+
+    def set_entry(self, path, oid, st):
+        """
+        Stage the oid together with the stat data it was hashed from
+        """
+        self[path] = oid
+        if self.stats.get(path) != stat_of(st):
+            self.stats[path] = stat_of(st)
+            self.modified = True
+
+    def cached_oid(self, path, st):
+        """
+        Return the staged oid if the file is unchanged since it was hashed
+        """
+        recorded = self.stats.get(path)
+        if recorded is None or recorded != stat_of(st):
+            return None
+
+        # Racily clean: changed within the same tick the index was written
+        if self.timestamp is None or recorded.mtime >= self.timestamp:
+            return None
+
+        return self[path]
+
+
+def _read_index():
+    """
+    Load the index file, also understands the old JSON index
+    """
+    index = Index()
+    path = f"{GIT_DIR}/index"
+    if not os.path.isfile(path):
+        return index
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    index.timestamp = os.stat(path).st_mtime_ns
+
+    if raw.startswith(b"{"):
+        index.update(json.loads(raw))
+        index.modified = False
+        return index
+
+    assert hashlib.sha1(raw[:-20]).digest() == raw[-20:], "Corrupt index"
+    magic, version, count = _INDEX_HEADER.unpack_from(raw)
+    assert magic == b"XIDX" and version == _INDEX_VERSION, "Unknown index"
+
+    pos = _INDEX_HEADER.size
+    for _ in range(count):
+        *st, oid, length = _INDEX_ENTRY.unpack_from(raw, pos)
+        pos += _INDEX_ENTRY.size
+        path = raw[pos:pos + length].decode()
+        pos += length
+
+        index[path] = oid.hex()
+        if any(st):
+            index.stats[path] = IndexStat(*st)
+
+    index.modified = False
+    return index
+
+
+def _pack_index(index):
+    """
+    Serialize the index, entries without stat data are stored zeroed
+    """
+    out = bytearray(_INDEX_HEADER.pack(b"XIDX", _INDEX_VERSION, len(index)))
+    for path in sorted(index):
+        st = index.stats.get(path) or IndexStat(0, 0, 0, 0, 0)
+        encoded = path.encode()
+        out += _INDEX_ENTRY.pack(*st, bytes.fromhex(index[path]), len(encoded))
+        out += encoded
+    out += hashlib.sha1(out).digest()
+    return bytes(out)
+
+
+def read_index():
+    """
+    Read only access to the index, changes to it are never written
+    """
+    return _read_index()
+
+
+def _lock_index():
+    """
+    Create index.lock, None when another process already holds it
+    """
+    try:
+        return os.open(f"{GIT_DIR}/index.lock",
+                       os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return None
+
+
+@contextmanager
+def _locked_index(fd):
+    """
+    Yield the index while holding the lock
+    A modified index is written into the lock file, which is then renamed
+    over the index so readers never see a half written index
+    """
+    lock = f"{GIT_DIR}/index.lock"
+    with os.fdopen(fd, "wb") as f:
+        try:
+            index = _read_index()
+            yield index
+            if index.modified:
+                f.write(_pack_index(index))
+                f.flush()
+                os.replace(lock, f"{GIT_DIR}/index")
+                return
+        except BaseException:
+            os.remove(lock)
+            raise
+        os.remove(lock)
+
+
 @contextmanager
 def get_index():
     """
     Get indices and return in a dict form
     """
-    index = {}
-    if os.path.isfile(f"{GIT_DIR}/index"):
-        with open(f"{GIT_DIR}/index") as f:
-            index = json.load(f)
+    fd = _lock_index()
+    assert fd is not None, \
+        f"{GIT_DIR}/index.lock exists, is another xsgit process running?"
 
-    yield index
+    with _locked_index(fd) as index:
+        yield index
 
-    with open(f"{GIT_DIR}/index", "w") as f:
-        json.dump(index, f)
 
+def refresh_index_stats(stats):
+    """
+    Record fresh stat data {path: (oid, stat)} for files whose content
+    still matches the index, it is only a cache so give up when locked
+    """
+    fd = _lock_index()
+    if fd is None:
+        return
 
+    with _locked_index(fd) as index:
+        for path, (oid, st) in stats.items():
+            if index.get(path) == oid:
+                index.set_entry(path, oid, st)
+
+
+@trace.traced("hash", counter="hash_object")
 def hash_object(data, type_="blob"):
     """
     Perform hashing for the data in the initialized repo
@@ -131,20 +567,159 @@ def hash_object(data, type_="blob"):
     # TODO: change to stronger encryption
     oid = hashlib.sha1(obj).hexdigest()
 
-    # Write in binary mode
-    # TO-DO: Compress files into seperate directories for big-scale code
-    with open(f"{GIT_DIR}/objects/{oid}", "wb") as out:
-        out.write(obj)
+    if not _freshen_object(oid):
+        _write_object(oid, obj)
     return oid
 
 
+def hash_data(data, type_="blob"):
+    """
+    Return the oid the data would be stored under, without storing it
+    For read only commands like status and diff
+    """
+    return hashlib.sha1(type_.encode() + b"\x00" + data).hexdigest()
+
+
+# Big files are read in chunks of this size
+_CHUNK_SIZE = 1 << 16
+
+
+@trace.traced("hash")
+def hash_file(path, type_="blob", write=True):
+    """
+    Hash a file chunk by chunk, so it is never held in memory as a whole
+    Only read it a second time to compress it into the store when the
+    object is not there yet
+    """
+    with open(path, "rb") as f:
+        oid = _hash_stream(f, type_)
+        if write and not _freshen_object(oid):
+            f.seek(0)
+            # The file may have changed in between, trust this pass
+            oid = _write_object_stream(f, type_)
+    return oid
+
+
+def _hash_stream(f, type_):
+    """
+    Sha1 of the object built from the type and the file's content
+    """
+    sha = hashlib.sha1(type_.encode() + b"\x00")
+    for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+@trace.traced("object write")
+def _write_object_stream(f, type_):
+    """
+    Hash and compress the file into a temporary object, return its oid
+    """
+    sha = hashlib.sha1()
+    compressor = zlib.compressobj()
+    with _temp_object() as out:
+        for chunk in itertools.chain((type_.encode() + b"\x00",),
+                                     iter(lambda: f.read(_CHUNK_SIZE), b"")):
+            sha.update(chunk)
+            out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+        trace.count("bytes written", out.tell())
+
+    oid = sha.hexdigest()
+    _move_object_into_place(out.name, oid)
+    return oid
+
+
+class ObjectCache:
+    """
+    Least recently used objects of the process, bounded by their size
+    Holds raw objects as well as what commands parse out of them, keyed by
+    (kind, oid) so a commit's bytes and its parsed form live side by side
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kind, oid):
+        """
+        Return the cached value or None, a hit makes it the newest entry
+        """
+        key = (GIT_DIR, kind, oid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, kind, oid, value, size):
+        """
+        Cache value as weighing size bytes, evict the oldest to fit
+        Values too big for a fair share of the cache are not kept
+        """
+        if size > self.limit // 4:
+            return
+        key = (GIT_DIR, kind, oid)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.limit:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Counters to tune core.objectcachesize with
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries), "size": self.size,
+                "limit": self.limit}
+
+
+_DEFAULT_OBJECT_CACHE_SIZE = 32 << 20
+
+# Created on first use, the limit comes from the repo's config
+_object_cache = None
+
+
+def get_object_cache():
+    """
+    The process wide object cache, core.objectcachesize bytes big
+    """
+    global _object_cache
+    if _object_cache is None:
+        _object_cache = ObjectCache(int(get_config(
+            "core.objectcachesize", _DEFAULT_OBJECT_CACHE_SIZE)))
+    return _object_cache
+
+
+@trace.traced(counter="get_object")
 def get_object(oid, expected="blob"):
     """
     Read binary contents in hashed oid file
     Partition by null byte and return the contents
     """
-    with open(f"{GIT_DIR}/objects/{oid}", "rb") as f:
-        obj = f.read()
+    cache = get_object_cache()
+    obj = cache.get("raw", oid)
+    if obj is None:
+        obj = _read_object(oid)
+        cache.put("raw", oid, obj, len(obj))
+        trace.count("bytes read", len(obj))
 
     type_, _, content = obj.partition(b"\x00")
     type_ = type_.decode()
@@ -154,29 +729,710 @@ def get_object(oid, expected="blob"):
     return content
 
 
+def _object_path(oid):
+    """
+    Path of a loose object, fanned out by the first two hex chars of its oid
+    """
+    return f"{GIT_DIR}/objects/{oid[:2]}/{oid[2:]}"
+
+
+def _legacy_object_path(oid):
+    """
+    Path of an object in the old flat and uncompressed layout
+    """
+    return f"{GIT_DIR}/objects/{oid}"
+
+
+@trace.traced("object write")
+def _write_object(oid, obj):
+    """
+    Store the zlib compressed object under its fanout directory
+    """
+    compressed = zlib.compress(obj)
+    with _temp_object() as out:
+        out.write(compressed)
+    _move_object_into_place(out.name, oid)
+    trace.count("bytes written", len(compressed))
+
+
+def _temp_object():
+    """
+    Temporary file in the object store, renamed into place once complete
+    """
+    return tempfile.NamedTemporaryFile(dir=f"{GIT_DIR}/objects",
+                                       prefix="tmp_obj_", delete=False)
+
+
+def _move_object_into_place(tmp_path, oid):
+    """
+    Atomically rename a complete temporary object to its final path
+    """
+    path = _object_path(oid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, path)
+
+
+@trace.traced("object read")
+def _read_object(oid):
+    """
+    Return the raw object (type, null byte and content)
+    Look in the packs first, then the loose objects
+    Fall back to the flat layout for repos that were not migrated
+    """
+    obj = _read_packed_object(oid)
+    if obj is not None:
+        return obj
+
+    path = _object_path(oid)
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return zlib.decompress(f.read())
+
+    try:
+        with open(_legacy_object_path(oid), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        # The object may have been packed after the packs were loaded
+        _packs.pop(GIT_DIR, None)
+        obj = _read_packed_object(oid)
+        if obj is None:
+            raise
+        return obj
+
+
 def object_exists(oid):
     """
     Check object exists in local
     """
-    return os.path.isfile(f"{GIT_DIR}/objects/{oid}")
+    return (_find_packed_object(oid) is not None or
+            os.path.isfile(_object_path(oid)) or
+            os.path.isfile(_legacy_object_path(oid)))
 
 
-def fetch_object_if_missing(oid, remote_git_dir):
+def _freshen_object(oid):
     """
-    Check if exists and then append
+    Reset the mtime of a stored object, return whether it is stored
+    An object written again is in use again, gc must not prune it before a
+    whole grace period has passed
     """
-    if object_exists(oid):
-        return
+    for path in (_object_path(oid), _legacy_object_path(oid)):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            pass
 
-    remote_git_dir += "/.xsgit"
-    shutil.copy(f"{remote_git_dir}/objects/{oid}",
-                f"{GIT_DIR}/objects/{oid}")
+    found = _find_packed_object(oid)
+    if found is None:
+        return False
+    os.utime(f"{_pack_dir()}/{found[0].name}.pack")
+    return True
 
 
-def push_object(oid, remote_git_dir):
+def iter_loose_objects():
     """
-    Push object to remote
+    Yield the oid of every loose object, in both layouts
+    """
+    objects_dir = f"{GIT_DIR}/objects"
+    for name in os.listdir(objects_dir):
+        path = f"{objects_dir}/{name}"
+        if len(name) == 40 and os.path.isfile(path):
+            yield name
+        elif len(name) == 2 and os.path.isdir(path):
+            for rest in os.listdir(path):
+                if len(rest) == 38:
+                    yield name + rest
+
+
+def migrate_objects():
     """
-    remote_git_dir += "/.xsgit"
-    shutil.copy(f"{GIT_DIR}/objects/{oid}",
-                f"{remote_git_dir}/objects/{oid}")
+    Move objects of the flat layout into compressed fanout directories
+    Return the number of objects moved
+    """
+    moved = 0
+    for name in os.listdir(f"{GIT_DIR}/objects"):
+        path = _legacy_object_path(name)
+        if len(name) != 40 or not os.path.isfile(path):
+            continue
+
+        with open(path, "rb") as f:
+            _write_object(name, f.read())
+        os.remove(path)
+        moved += 1
+
+    return moved
+
+
+# Pack files keep many objects in one file, compressed and possibly stored
+# as a delta against a similar object. Each pack has an index with the sorted
+# oids and their offsets, with a fanout table to narrow down the search:
+#
+# pack: "PACK" version count, then per object:
+#       type, size, compressed size, [base oid], zlib data
+#       and a trailing sha1 of everything before it
+# idx:  "PIDX" version, fanout[256], oids[count], offsets[count],
+#       pack sha1
+Pack = namedtuple("Pack", ["name", "fanout", "idx", "data"])
+
+_PACK_TYPES = {"commit": 1, "tree": 2, "blob": 3}
+_PACK_TYPE_NAMES = {code: type_ for type_, code in _PACK_TYPES.items()}
+_PACK_DELTA = 7
+_PACK_VERSION = 1
+_PACK_HEADER = struct.Struct(">4sII")
+_IDX_HEADER = struct.Struct(">4sI")
+_IDX_FANOUT = struct.Struct(">256I")
+
+# Only try deltas against the last few objects of similar type and size
+_DELTA_WINDOW = 10
+_DELTA_MAX_DEPTH = 10
+_DELTA_MIN_SIZE = 64
+_DELTA_MAX_SIZE = 1 << 20
+_DELTA_BLOCK = 16
+
+# Loaded packs per git directory
+_packs = {}
+
+
+def _pack_dir():
+    """
+    Directory that holds the packs and their indices
+    """
+    return f"{GIT_DIR}/objects/pack"
+
+
+def _get_packs():
+    """
+    Map every pack of the current repo into memory, once per process
+    """
+    packs = _packs.get(GIT_DIR)
+    if packs is None:
+        packs = []
+        if os.path.isdir(_pack_dir()):
+            for name in sorted(os.listdir(_pack_dir())):
+                if name.endswith(".idx"):
+                    packs.append(_open_pack(name[:-len(".idx")]))
+        _packs[GIT_DIR] = packs
+    return packs
+
+
+def _map_file(path):
+    """
+    Read only memory map of a whole file
+    """
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _open_pack(name):
+    """
+    Map the pack and its index, the fanout table is read once
+    """
+    idx = _map_file(f"{_pack_dir()}/{name}.idx")
+    magic, version = _IDX_HEADER.unpack_from(idx)
+    assert magic == b"PIDX" and version == _PACK_VERSION, f"Bad index {name}"
+
+    fanout = _IDX_FANOUT.unpack_from(idx, _IDX_HEADER.size)
+    data = _map_file(f"{_pack_dir()}/{name}.pack")
+    return Pack(name=name, fanout=fanout, idx=idx, data=data)
+
+
+def _find_in_pack(pack, oid):
+    """
+    Binary search the oid in the index, return its offset in the pack
+    """
+    key = bytes.fromhex(oid)
+    lo = pack.fanout[key[0] - 1] if key[0] else 0
+    hi = pack.fanout[key[0]]
+    count = pack.fanout[255]
+    oids_start = _IDX_HEADER.size + _IDX_FANOUT.size
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = oids_start + mid * 20
+        found = pack.idx[pos:pos + 20]
+        if found == key:
+            pos = oids_start + count * 20 + mid * 8
+            return struct.unpack_from(">Q", pack.idx, pos)[0]
+        if found < key:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return None
+
+
+def _find_packed_object(oid):
+    """
+    Return the pack and offset holding the oid if any
+    """
+    for pack in _get_packs():
+        offset = _find_in_pack(pack, oid)
+        if offset is not None:
+            return pack, offset
+    return None
+
+
+def _read_packed_object(oid):
+    """
+    Return the raw object from the packs, None if it is not packed
+    """
+    found = _find_packed_object(oid)
+    if found is None:
+        return None
+    return _read_pack_entry(*found)
+
+
+def _read_pack_entry(pack, offset):
+    """
+    Inflate the entry at offset, applying deltas onto their bases
+    """
+    code = pack.data[offset]
+    size, pos = _decode_varint(pack.data, offset + 1)
+    zsize, pos = _decode_varint(pack.data, pos)
+
+    if code == _PACK_DELTA:
+        base_oid = pack.data[pos:pos + 20].hex()
+        pos += 20
+        delta = zlib.decompress(pack.data[pos:pos + zsize])
+        type_, _, base = _read_object(base_oid).partition(b"\x00")
+        content = _apply_delta(base, delta)
+    else:
+        type_ = _PACK_TYPE_NAMES[code].encode()
+        content = zlib.decompress(pack.data[pos:pos + zsize])
+
+    assert len(content) == size, f"Corrupt object in pack {pack.name}"
+    return type_ + b"\x00" + content
+
+
+def _encode_varint(n):
+    """
+    Little endian base 128, the high bit marks that more bytes follow
+    """
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    """
+    Return the decoded number and the position after it
+    """
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
+
+
+def _make_delta(base, target, limit=None):
+    """
+    Describe target as copies from base and inserted literal bytes
+    Index base in fixed blocks and extend every block match both ways
+    Give up and return None as soon as the delta can't be under limit
+
+    delta: base size, target size, then per instruction either
+           0x80 offset size (copy from base) or n bytes (insert, n < 128)
+    """
+    out = bytearray(_encode_varint(len(base)) + _encode_varint(len(target)))
+
+    def insert(literal):
+        for i in range(0, len(literal), 0x7f):
+            chunk = literal[i:i + 0x7f]
+            out.append(len(chunk))
+            out.extend(chunk)
+
+    blocks = {}
+    for i in range(0, len(base) - _DELTA_BLOCK + 1, _DELTA_BLOCK):
+        blocks.setdefault(base[i:i + _DELTA_BLOCK], i)
+
+    literal_start = j = 0
+    while j <= len(target) - _DELTA_BLOCK:
+        if limit is not None and len(out) + j - literal_start >= limit:
+            return None
+        i = blocks.get(target[j:j + _DELTA_BLOCK])
+        if i is None:
+            j += 1
+            continue
+
+        # Grow the match back into the pending literal
+        while j > literal_start and i > 0 and target[j - 1] == base[i - 1]:
+            i -= 1
+            j -= 1
+
+        # Grow it forward, in chunks first and then byte by byte
+        n = _DELTA_BLOCK
+        while True:
+            step = min(64, len(target) - j - n, len(base) - i - n)
+            if step <= 0:
+                break
+            if target[j + n:j + n + step] != base[i + n:i + n + step]:
+                break
+            n += step
+        while (j + n < len(target) and i + n < len(base) and
+               target[j + n] == base[i + n]):
+            n += 1
+
+        insert(target[literal_start:j])
+        out.append(0x80)
+        out.extend(_encode_varint(i) + _encode_varint(n))
+        j += n
+        literal_start = j
+
+    insert(target[literal_start:])
+    return bytes(out)
+
+
+def _apply_delta(base, delta):
+    """
+    Rebuild the target from the base and the delta instructions
+    """
+    base_size, pos = _decode_varint(delta, 0)
+    size, pos = _decode_varint(delta, pos)
+    assert base_size == len(base), "Delta does not match its base"
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset, pos = _decode_varint(delta, pos)
+            n, pos = _decode_varint(delta, pos)
+            out += base[offset:offset + n]
+        else:
+            out += delta[pos:pos + op]
+            pos += op
+
+    assert len(out) == size, "Delta produced the wrong size"
+    return bytes(out)
+
+
+def _write_pack_data(f, oids, deltas=True):
+    """
+    Write the objects as a pack into f and return [(oid, offset)], checksum
+    Objects are sorted by type and size so that similar objects end up in
+    the same delta window, bases are always written before their deltas
+    Without deltas every object is only zlib compressed
+    """
+    # First pass only looks at the sizes, to not hold every object in memory
+    order = []
+    for oid in oids:
+        type_, _, content = _read_object(oid).partition(b"\x00")
+        order.append((type_, len(content), oid))
+    order.sort(key=lambda entry: (entry[0], -entry[1]))
+
+    checksum = hashlib.sha1()
+
+    def write(chunk):
+        checksum.update(chunk)
+        f.write(chunk)
+
+    write(_PACK_HEADER.pack(b"PACK", _PACK_VERSION, len(order)))
+    offset = _PACK_HEADER.size
+
+    entries = []
+    window = []
+    for type_, size, oid in order:
+        content = _read_object(oid).partition(b"\x00")[2]
+
+        best = None
+        if deltas and _DELTA_MIN_SIZE <= size <= _DELTA_MAX_SIZE:
+            for base_type, base_oid, base, depth in window:
+                if base_type != type_ or depth >= _DELTA_MAX_DEPTH:
+                    continue
+                limit = len(best[1]) if best else size // 2
+                delta = _make_delta(base, content, limit)
+                if delta is not None and len(delta) < limit:
+                    best = (base_oid, delta, depth + 1)
+
+        if best:
+            base_oid, delta, depth = best
+            payload = zlib.compress(delta)
+            header = bytes([_PACK_DELTA]) + _encode_varint(size)
+            header += _encode_varint(len(payload)) + bytes.fromhex(base_oid)
+        else:
+            depth = 0
+            payload = zlib.compress(content)
+            header = bytes([_PACK_TYPES[type_.decode()]])
+            header += _encode_varint(size) + _encode_varint(len(payload))
+
+        write(header)
+        write(payload)
+        entries.append((oid, offset))
+        offset += len(header) + len(payload)
+
+        if size <= _DELTA_MAX_SIZE:
+            window.append((type_, oid, content, depth))
+            del window[:-_DELTA_WINDOW]
+
+    f.write(checksum.digest())
+    return entries, checksum.hexdigest()
+
+
+def _write_pack_index(f, entries, pack_checksum):
+    """
+    Write the index of a pack: fanout table, sorted oids and offsets
+    """
+    entries = sorted((bytes.fromhex(oid), offset) for oid, offset in entries)
+
+    fanout = [0] * 256
+    for key, _ in entries:
+        fanout[key[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    f.write(_IDX_HEADER.pack(b"PIDX", _PACK_VERSION))
+    f.write(_IDX_FANOUT.pack(*fanout))
+    f.write(b"".join(key for key, _ in entries))
+    f.write(b"".join(struct.pack(">Q", offset) for _, offset in entries))
+    f.write(bytes.fromhex(pack_checksum))
+
+
+@trace.traced("object write")
+def write_pack(oids):
+    """
+    Store the objects in a new pack, return the pack name
+    """
+    oids = list(dict.fromkeys(oids))
+    if not oids:
+        return None
+
+    os.makedirs(_pack_dir(), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=_pack_dir(), delete=False) as f:
+        entries, checksum = _write_pack_data(f, oids)
+        trace.count("bytes written", f.tell())
+    return _install_pack(f.name, entries, checksum)
+
+
+def _install_pack(tmp_path, entries, checksum):
+    """
+    Rename a complete temporary pack into place and write its index
+    The index is renamed last, so readers never see half a pack
+    """
+    name = f"pack-{checksum}"
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, f"{_pack_dir()}/{name}.pack")
+
+    with tempfile.NamedTemporaryFile(dir=_pack_dir(), delete=False) as f:
+        _write_pack_index(f, entries, checksum)
+    os.chmod(f.name, 0o444)
+    os.replace(f.name, f"{_pack_dir()}/{name}.idx")
+
+    _packs.pop(GIT_DIR, None)
+    return name
+
+
+def pack_loose_objects():
+    """
+    Move every loose object into a single new pack
+    Return the number of objects packed
+    """
+    oids = list(iter_loose_objects())
+    write_pack(oids)
+
+    for oid in oids:
+        for path in (_object_path(oid), _legacy_object_path(oid)):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    return len(oids)
+
+
+def iter_packed_objects():
+    """
+    Yield the oid of every packed object
+    """
+    for pack in _get_packs():
+        yield from _iter_pack_oids(pack)
+
+
+def _iter_pack_oids(pack):
+    """
+    Oids of the objects in a pack, from its index
+    """
+    oids_start = _IDX_HEADER.size + _IDX_FANOUT.size
+    for i in range(pack.fanout[255]):
+        pos = oids_start + i * 20
+        yield pack.idx[pos:pos + 20].hex()
+
+
+def object_store_size():
+    """
+    Bytes the loose objects and the packs take on disk
+    """
+    total = 0
+    for oid in iter_loose_objects():
+        for path in (_object_path(oid), _legacy_object_path(oid)):
+            if os.path.isfile(path):
+                total += os.path.getsize(path)
+    for pack in _get_packs():
+        total += os.path.getsize(f"{_pack_dir()}/{pack.name}.pack")
+        total += os.path.getsize(f"{_pack_dir()}/{pack.name}.idx")
+    return total
+
+
+# Temporary files younger than this may belong to a command still running,
+# whatever the grace period of unreachable objects
+_TEMP_FILE_AGE = 6 * 3600
+
+
+def repack_objects(keep, grace):
+    """
+    Pack the objects to keep into a single pack, then drop the old packs
+    and the loose objects
+    Objects not kept are only pruned once older than grace seconds, as a
+    running command may be about to reference them, the ones in recent
+    packs are kept loose with the age of their pack until then
+    Return the number of objects pruned
+    """
+    now = time.time()
+    old_packs = _get_packs()
+    pruned = 0
+
+    for pack in old_packs:
+        path = f"{_pack_dir()}/{pack.name}.pack"
+        mtime = os.stat(path).st_mtime
+        for oid in _iter_pack_oids(pack):
+            if oid in keep:
+                continue
+            if now - mtime >= grace:
+                pruned += 1
+            elif not os.path.isfile(_object_path(oid)):
+                _write_object(oid, _read_object(oid))
+                os.utime(_object_path(oid), (mtime, mtime))
+
+    name = write_pack(keep)
+    for pack in old_packs:
+        if pack.name != name:
+            # Index first, a pack without one is never looked at
+            os.remove(f"{_pack_dir()}/{pack.name}.idx")
+            os.remove(f"{_pack_dir()}/{pack.name}.pack")
+    _packs.pop(GIT_DIR, None)
+
+    for oid in list(iter_loose_objects()):
+        for path in (_object_path(oid), _legacy_object_path(oid)):
+            if not os.path.isfile(path):
+                continue
+            if oid in keep:
+                os.remove(path)
+            elif now - os.stat(path).st_mtime >= grace:
+                os.remove(path)
+                pruned += 1
+
+    # Temporary files left behind by commands that were interrupted
+    for root, _, fnames in os.walk(f"{GIT_DIR}/objects"):
+        for fname in fnames:
+            if not fname.startswith("tmp"):
+                continue
+            path = f"{root}/{fname}"
+            try:
+                if now - os.stat(path).st_mtime >= _TEMP_FILE_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                # Renamed into place in the meantime
+                pass
+
+    # Fanout directories left empty
+    for fname in os.listdir(f"{GIT_DIR}/objects"):
+        path = f"{GIT_DIR}/objects/{fname}"
+        if len(fname) == 2 and os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+
+    return pruned
+
+
+@trace.traced("object write")
+def write_pack_stream(f, oids, deltas=True):
+    """
+    Write the objects as one self contained pack into the stream f
+    This is the transfer format between repos, deltas only refer to
+    objects earlier in the same pack
+    """
+    _write_pack_data(f, list(dict.fromkeys(oids)), deltas)
+
+
+@trace.traced("object write")
+def index_pack(f):
+    """
+    Store the pack read from the stream f, return the pack name
+    Objects are hashed and their deltas resolved as they are read, so the
+    pack is indexed and verified in a single pass over the stream
+    """
+    os.makedirs(_pack_dir(), exist_ok=True)
+    checksum = hashlib.sha1()
+
+    with tempfile.NamedTemporaryFile(dir=_pack_dir(), delete=False) as out:
+        def read(n):
+            chunk = f.read(n)
+            assert len(chunk) == n, "Truncated pack"
+            checksum.update(chunk)
+            out.write(chunk)
+            return chunk
+
+        def read_varint():
+            raw = bytearray()
+            while not raw or raw[-1] & 0x80:
+                raw += read(1)
+            return _decode_varint(raw, 0)[0], len(raw)
+
+        try:
+            magic, version, count = _PACK_HEADER.unpack(
+                read(_PACK_HEADER.size))
+            assert magic == b"PACK" and version == _PACK_VERSION, "Bad pack"
+
+            offset = _PACK_HEADER.size
+            entries = []
+            # Delta bases are among the last objects the sender wrote
+            window = OrderedDict()
+            for _ in range(count):
+                code = read(1)[0]
+                size, size_len = read_varint()
+                zsize, zsize_len = read_varint()
+                header_len = 1 + size_len + zsize_len
+
+                if code == _PACK_DELTA:
+                    base_oid = read(20).hex()
+                    header_len += 20
+                    delta = zlib.decompress(read(zsize))
+                    if base_oid in window:
+                        type_, base = window[base_oid]
+                    else:
+                        type_, _, base = _read_object(base_oid).partition(
+                            b"\x00")
+                    content = _apply_delta(base, delta)
+                else:
+                    type_ = _PACK_TYPE_NAMES[code].encode()
+                    content = zlib.decompress(read(zsize))
+                assert len(content) == size, "Corrupt object in pack"
+
+                oid = hashlib.sha1(type_ + b"\x00" + content).hexdigest()
+                entries.append((oid, offset))
+                offset += header_len + zsize
+
+                # Same window as the writer, which skips the big objects
+                if size <= _DELTA_MAX_SIZE:
+                    window[oid] = (type_, content)
+                    while len(window) > _DELTA_WINDOW:
+                        window.popitem(last=False)
+
+            pack_checksum = checksum.hexdigest()
+            trailer = f.read(20)
+            assert trailer.hex() == pack_checksum, "Pack checksum mismatch"
+            out.write(trailer)
+            trace.count("bytes written", out.tell())
+        except BaseException:
+            out.close()
+            os.remove(out.name)
+            raise
+
+    if not entries:
+        os.remove(out.name)
+        return None
+
+    return _install_pack(out.name, entries, pack_checksum)
@@ -1,9 +1,9 @@
 import subprocess
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from tempfile import NamedTemporaryFile as Temp
 
-from . import data
+from . import base, data, trace
 
 
 def compare_trees(*trees):
@@ -22,63 +22,615 @@ def compare_trees(*trees):
         yield (path, *oids)
 
 
+def iter_tree_diff(o_ori, o_dest, base_path="", trees=None):
+    """
+    Compare two tree objects level by level
+    Yield (path, oid_ori, oid_dest) for every blob that differs, subtrees
+    with the same oid on both sides are never read
+    trees holds entries of trees that were hashed but not stored
+    """
+    if o_ori == o_dest:
+        return
+
+    ori = _tree_entries(o_ori, trees)
+    dest = _tree_entries(o_dest, trees)
+    for name in sorted(ori.keys() | dest.keys()):
+        type_ori, oid_ori = ori.get(name, (None, None))
+        type_dest, oid_dest = dest.get(name, (None, None))
+        if (type_ori, oid_ori) == (type_dest, oid_dest):
+            continue
+
+        path = base_path + name
+        # A path can turn from a file into a directory or the other way
+        if "tree" in (type_ori, type_dest):
+            yield from iter_tree_diff(
+                oid_ori if type_ori == "tree" else None,
+                oid_dest if type_dest == "tree" else None,
+                f"{path}/", trees)
+        if "blob" in (type_ori, type_dest):
+            yield (path,
+                   oid_ori if type_ori == "blob" else None,
+                   oid_dest if type_dest == "blob" else None)
+
+
+def _tree_entries(oid, trees):
+    """
+    Entries of a tree, from the hashed trees first and then the store
+    """
+    if not oid:
+        return {}
+    if trees and oid in trees:
+        return trees[oid]
+    return base.get_tree_entries(oid)
+
+
+def _iter_changes(t_ori, t_dest):
+    """
+    Yield (path, oid_ori, oid_dest) for every path that differs
+    A tree is either a tree oid or a flat dict of path to oid, as soon as one
+    side is an oid, both sides are compared as trees so that unchanged
+    subtrees are skipped
+    """
+    if isinstance(t_ori, dict) and isinstance(t_dest, dict):
+        for path, o_ori, o_dest in compare_trees(t_ori, t_dest):
+            if o_ori != o_dest:
+                yield path, o_ori, o_dest
+        return
+
+    trees = {}
+    sides = []
+    for tree in (t_ori, t_dest):
+        if isinstance(tree, dict):
+            tree, hashed = base.hash_tree(tree)
+            trees.update(hashed)
+        sides.append(tree)
+
+    yield from iter_tree_diff(*sides, trees=trees)
+
+
 def iter_changed_files(t_ori, t_dest):
     """
     Generator or the path and the action type
     """
-    for path, o_ori, o_dest in compare_trees(t_ori, t_dest):
-        if o_ori != o_dest:
-            action = ("new file" if not o_ori else
-                      "deleted" if not o_dest else
-                      "modified")
-            yield path, action
+    for path, o_ori, o_dest in _iter_changes(t_ori, t_dest):
+        action = ("new file" if not o_ori else
+                  "deleted" if not o_dest else
+                  "modified")
+        yield path, action
 
 
-def diff_trees(t_ori, t_dest):
+def diff_trees(t_ori, t_dest, working=False):
     """
     Return the difference in the trees/commits
+    With working, t_dest is the working tree and its files are read directly
     """
+    external = _use_external_diff()
     output = b""
-    for path, o_ori, o_dest in compare_trees(t_ori, t_dest):
-        # Append change string if origin and destination aren't the same
-        if o_ori != o_dest:
-            output += diff_blobs(o_ori, o_dest, path)
+    for path, o_ori, o_dest in _iter_changes(t_ori, t_dest):
+        output += diff_blobs(o_ori, o_dest, path, working, external)
     return output
 
 
-def diff_blobs(o_ori, o_dest, path="blob"):
+def _use_external_diff():
+    """
+    Whether diff.external asks for the diff tool instead of the built in diff
+    """
+    return data.get_config("diff.external", "false").lower() == "true"
+
+
+def diff_blobs(o_ori, o_dest, path="blob", working=False, external=None):
     """
     Check the difference in each commit/blob
     """
+    if external is None:
+        external = _use_external_diff()
+    if external:
+        return _diff_blobs_external(o_ori, o_dest, path, working)
+
+    ori = data.get_object(o_ori) if o_ori else b""
+    dest = b""
+    # Working files were never stored as objects, diff the file itself
+    if o_dest and working:
+        with open(path, "rb") as f:
+            dest = f.read()
+    elif o_dest:
+        dest = data.get_object(o_dest)
+
+    return unified_diff(ori, dest, f"a/{path}", f"b/{path}")
+
+
+@trace.traced("diff subprocess")
+def _diff_blobs_external(o_ori, o_dest, path, working):
+    """
+    Same as diff_blobs but runs the diff tool on temporary files
+    """
     # Create a temporary file and make changes on it
     with Temp() as f_ori, Temp() as f_dest:
-        for oid, f in ((o_ori, f_ori), (o_dest, f_dest)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
+        if o_ori:
+            f_ori.write(data.get_object(o_ori))
+            f_ori.flush()
+
+        # Working files were never stored as objects, diff the file itself
+        dest = f_dest.name
+        if o_dest and working:
+            dest = path
+        elif o_dest:
+            f_dest.write(data.get_object(o_dest))
+            f_dest.flush()
+
         # Piping the output into stdout
         with subprocess.Popen(
             ["diff", "--unified", "--show-c-function",
              "--label", f"a/{path}", f_ori.name,
-             "--label", f"b/{path}", f_dest.name],
+             "--label", f"b/{path}", dest],
                 stdout=subprocess.PIPE) as proc:
             output, _ = proc.communicate()
 
     return output
 
 
-def merge_trees(t_base, t_HEAD, t_other):
+# Lines of context around changes, same as diff --unified
+CONTEXT = 3
+# Like diff --show-c-function, a function line starts with a letter, $ or _
+# and is cut to 40 bytes
+_FUNCTION_START = frozenset(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ$_")
+_FUNCTION_MAX = 40
+# Like Git, content with a null byte in its beginning is binary
+_BINARY_CHECK = 8000
+
+
+@trace.traced("diff")
+def unified_diff(ori, dest, label_ori, label_dest, context=CONTEXT):
+    """
+    Unified diff of two contents with function context, formatted like the
+    output of diff --unified --show-c-function
+    """
+    if ori == dest:
+        return b""
+
+    if b"\x00" in ori[:_BINARY_CHECK] or b"\x00" in dest[:_BINARY_CHECK]:
+        return (f"Binary files {label_ori} and {label_dest} differ\n"
+                .encode())
+
+    a = ori.splitlines(keepends=True)
+    b = dest.splitlines(keepends=True)
+
+    out = [f"--- {label_ori}\n+++ {label_dest}\n".encode()]
+    find_function = _function_finder(a)
+
+    for group in _group_opcodes(_opcodes(a, b), context):
+        i1, i2 = group[0][1], group[-1][2]
+        j1, j2 = group[0][3], group[-1][4]
+        header = b"@@ -%s +%s @@" % (_hunk_range(i1, i2), _hunk_range(j1, j2))
+        function = find_function(i1)
+        if function:
+            header += b" " + function
+        out.append(header + b"\n")
+
+        for tag, t1, t2, u1, u2 in group:
+            if tag == "equal":
+                out.extend(_hunk_lines(b" ", a[t1:t2]))
+                continue
+            out.extend(_hunk_lines(b"-", a[t1:t2]))
+            out.extend(_hunk_lines(b"+", b[u1:u2]))
+
+    return b"".join(out)
+
+
+def _hunk_range(start, end):
+    """
+    Range of a hunk header, 1-based, the count is left out when it is 1
+    """
+    count = end - start
+    if count == 1:
+        return b"%d" % (start + 1)
+    # An empty range names the line before it
+    return b"%d,%d" % (start + 1 if count else start, count)
+
+
+def _hunk_lines(prefix, lines):
+    """
+    Prefix every line and mark a last line that has no newline
+    """
+    for line in lines:
+        if line.endswith(b"\n"):
+            yield prefix + line
+        else:
+            yield prefix + line + b"\n\\ No newline at end of file\n"
+
+
+def _function_finder(lines):
+    """
+    Return a function giving the last function line before a line number
+    Hunks come in order, so every line is only searched once
+    """
+    state = {"searched": 0, "found": None}
+
+    def find(linenum):
+        for line in lines[state["searched"]:linenum]:
+            if line[:1] and line[0] in _FUNCTION_START:
+                state["found"] = line
+        state["searched"] = max(state["searched"], linenum)
+
+        function = state["found"]
+        if function is None:
+            return None
+        return function[:_FUNCTION_MAX].rstrip()
+
+    return find
+
+
+def _opcodes(a, b):
+    """
+    Turn the matching lines into (tag, i1, i2, j1, j2) like difflib
+    """
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in _matching_blocks(a, b):
+        if i < ai or j < bj:
+            tag = ("replace" if i < ai and j < bj else
+                   "delete" if i < ai else
+                   "insert")
+            opcodes.append((tag, i, ai, j, bj))
+        if size:
+            opcodes.append(("equal", ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return opcodes
+
+
+def _group_opcodes(opcodes, context):
+    """
+    Split the opcodes into hunks with context lines around the changes
+    Changes closer than twice the context share a hunk
+    """
+    if not opcodes:
+        return
+    opcodes = list(opcodes)
+
+    # Trim the leading and trailing equal runs to the context
+    tag, i1, i2, j1, j2 = opcodes[0]
+    if tag == "equal":
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    tag, i1, i2, j1, j2 = opcodes[-1]
+    if tag == "equal":
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        # Split a long equal run into the end of one hunk and start of next
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            yield group
+            group = []
+            i1, j1 = i2 - context, j2 - context
+        group.append((tag, i1, i2, j1, j2))
+
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _matching_blocks(a, b):
+    """
+    Return the (i, j, size) runs of lines common to a and b in order,
+    ending with a (len(a), len(b), 0) sentinel
+    """
+    # Compare small ints instead of lines
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+
+    # Lines only on one side can never match, leave them out of the search
+    in_a, in_b = set(a_ids), set(b_ids)
+    a_keep = [i for i, x in enumerate(a_ids) if x in in_b]
+    b_keep = [j for j, x in enumerate(b_ids) if x in in_a]
+
+    matches = []
+    _myers([a_ids[i] for i in a_keep], 0, len(a_keep),
+           [b_ids[j] for j in b_keep], 0, len(b_keep), matches)
+
+    # Lines left out of the matches changed, with a sentinel past the end
+    a_changed = [True] * len(a) + [False]
+    b_changed = [True] * len(b) + [False]
+    for i, j in matches:
+        a_changed[a_keep[i]] = b_changed[b_keep[j]] = False
+    _shift_boundaries(a_ids, a_changed, b_changed)
+    _shift_boundaries(b_ids, b_changed, a_changed)
+
+    # The unchanged lines of both sides pair up in order, sentinels last
+    blocks = []
+    for i, j in zip((i for i, x in enumerate(a_changed) if not x),
+                    (j for j, x in enumerate(b_changed) if not x)):
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and \
+                blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    blocks[-1][2] -= 1
+    if blocks[-1][2]:
+        blocks.append([len(a), len(b), 0])
+    return [tuple(block) for block in blocks]
+
+
+def _shift_boundaries(ids, changed, other):
+    """
+    Slide every run of changed lines down as far as the lines allow, the
+    way diff and git place them, so a change next to repeated lines (blank
+    lines, closing braces) comes out as they show it
+    A run that can line up with changed lines of the other side stops at
+    the lowest place it does, keeping the lines it replaces next to it
+    changed and other end with a False sentinel, runs of both sides go
+    together as the unchanged lines between them pair up
+    """
+    def slide_up(group):
+        start, end = group
+        if start == 0 or ids[start - 1] != ids[end - 1]:
+            return False
+        start -= 1
+        end -= 1
+        changed[start], changed[end] = True, False
+        while start and changed[start - 1]:
+            start -= 1
+        group[:] = start, end
+        return True
+
+    def slide_down(group):
+        start, end = group
+        if end == len(ids) or ids[start] != ids[end]:
+            return False
+        changed[start], changed[end] = False, True
+        start += 1
+        end += 1
+        while changed[end]:
+            end += 1
+        group[:] = start, end
+        return True
+
+    def previous(flags, group):
+        end = group[0] - 1
+        start = end
+        while start and flags[start - 1]:
+            start -= 1
+        group[:] = start, end
+
+    def next_(flags, group):
+        start = end = group[1] + 1
+        while flags[end]:
+            end += 1
+        group[:] = start, end
+
+    # Runs as [start, end), both start with the one before the first line
+    group = [0, -1]
+    other_group = [0, -1]
+    next_(changed, group)
+    next_(other, other_group)
+    while True:
+        if group[1] > group[0]:
+            while True:
+                size = group[1] - group[0]
+                while slide_up(group):
+                    previous(other, other_group)
+                earliest_end = group[1]
+                matches_other = other_group[1] > other_group[0]
+                while slide_down(group):
+                    next_(other, other_group)
+                    matches_other |= other_group[1] > other_group[0]
+                # Sliding merged it with another run, go again
+                if size == group[1] - group[0]:
+                    break
+
+            if group[1] != earliest_end and matches_other:
+                while other_group[1] == other_group[0]:
+                    slide_up(group)
+                    previous(other, other_group)
+
+        if group[1] == len(ids):
+            break
+        # Step over the unchanged lines both sides share in one go
+        skip = min(_unchanged_run(changed, group[1] + 1),
+                   _unchanged_run(other, other_group[1] + 1))
+        if skip:
+            group[:] = [group[1] + skip] * 2
+            other_group[:] = [other_group[1] + skip] * 2
+        else:
+            next_(changed, group)
+            next_(other, other_group)
+
+
+def _unchanged_run(flags, start):
+    """
+    Count the unchanged lines from start, up to and with the sentinel
+    """
+    try:
+        return flags.index(True, start) - start
+    except ValueError:
+        return len(flags) - start
+
+
+def _myers(a, alo, ahi, b, blo, bhi, matches):
+    """
+    Myers' linear space diff: split the ranges at the middle snake of the
+    shortest edit script and recurse on both sides
+    Appends the matching (i, j) line pairs to matches in order
+    """
+    # Common prefix and suffix are always part of the answer
+    prefix = []
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        prefix.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+
+    matches.extend(prefix)
+    if alo < ahi and blo < bhi:
+        x1, y1, x2, y2 = _middle_snake(a, alo, ahi, b, blo, bhi)
+        _myers(a, alo, x1, b, blo, y1, matches)
+        matches.extend(zip(range(x1, x2), range(y1, y2)))
+        _myers(a, x2, ahi, b, y2, bhi, matches)
+    matches.extend(reversed(suffix))
+
+
+# Past this many edits a split gives up on the shortest edit script
+_MAX_COST = 256
+
+
+def _middle_snake(a, alo, ahi, b, blo, bhi):
+    """
+    Run the greedy search from both ends until the paths overlap
+    Return the overlapping snake as (x1, y1, x2, y2) in absolute positions
+    Too expensive searches split at the furthest point reached instead
+    """
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    # Furthest x reached on every diagonal k, forward and backward
+    vf = {1: 0}
+    vb = {1: 0}
+
+    for d in range((n + m + 1) // 2 + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[k - 1] < vf[k + 1]):
+                x = vf[k + 1]
+            else:
+                x = vf[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[k] = x
+            if odd and delta - (d - 1) <= k <= delta + (d - 1) and \
+                    x + vb[delta - k] >= n:
+                return alo + x0, blo + y0, alo + x, blo + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[k - 1] < vb[k + 1]):
+                x = vb[k + 1]
+            else:
+                x = vb[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and \
+                    a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            vb[k] = x
+            if not odd and -d <= delta - k <= d and \
+                    x + vf[delta - k] >= n:
+                return ahi - x, bhi - y, ahi - x0, bhi - y0
+
+        if d >= _MAX_COST:
+            # Like diff's heuristic, not minimal but still a valid diff
+            x, y = max(((vf[k], vf[k] - k) for k in range(-d, d + 1, 2)
+                        if vf[k] <= n and 0 <= vf[k] - k <= m),
+                       key=sum)
+            return alo + x, blo + y, alo + x, blo + y
+
+    assert False, "Middle snake not found"
+
+
+def merge_tree_oids(o_base, o_HEAD, o_other, conflicts=None):
+    """
+    Three way merge of tree objects, return the oid of the merged tree
+    Subtrees with the same oid on two sides resolve without being read,
+    blobs are only merged when all three sides differ
+    A path that is a file on one side and a directory on the other keeps
+    HEAD's entry, MERGE_HEAD's is put next to it as path~MERGE_HEAD and the
+    path is added to conflicts
+    """
+    external = _use_external_merge()
+    if conflicts is None:
+        conflicts = []
+    merged = _merge_tree_entries(o_base, o_HEAD, o_other, external, "",
+                                 conflicts)
+    return merged or base.write_tree_entries({})
+
+
+def _merge_tree_entries(o_base, o_HEAD, o_other, external, path, conflicts):
+    """
+    Merge one level of the trees at path, None when nothing is left in it
+    """
+    if o_HEAD == o_base:
+        return o_other
+    if o_other == o_base or o_HEAD == o_other:
+        return o_HEAD
+
+    trees = [_tree_entries(oid, None) for oid in (o_base, o_HEAD, o_other)]
+    entries = {}
+    for name in sorted(set().union(*trees)):
+        e_base, e_HEAD, e_other = (tree.get(name) for tree in trees)
+
+        if e_HEAD == e_base:
+            entry = e_other
+        elif e_other == e_base or e_HEAD == e_other:
+            entry = e_HEAD
+        elif e_HEAD and e_other and e_HEAD[0] != e_other[0]:
+            entry = e_HEAD
+            entries[f"{name}~MERGE_HEAD"] = e_other
+            conflicts.append(f"{path}{name}")
+        else:
+            entry = _merge_entry(e_base, e_HEAD, e_other, external,
+                                 f"{path}{name}/", conflicts)
+
+        if entry:
+            entries[name] = entry
+
+    if not entries:
+        return None
+    return base.write_tree_entries(entries)
+
+
+def _merge_entry(e_base, e_HEAD, e_other, external, path, conflicts):
     """
-    Merge trees by merging blobs
+    Merge a (type, oid) entry that differs on all three sides, HEAD and
+    other are of the same type when both have it
     """
-    tree = {}
-    for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
-        tree[path] = data.hash_object(merge_blobs(o_base, o_HEAD, o_other))
+    type_ = (e_HEAD or e_other)[0]
+    if e_base and e_base[0] != type_:
+        if not (e_HEAD and e_other):
+            # Replaced by the other type on one side, deleted on the other
+            return e_HEAD or e_other
+        # Both sides replaced it the same way, nothing is left to share
+        e_base = None
+    o_base, o_HEAD, o_other = (entry and entry[1]
+                               for entry in (e_base, e_HEAD, e_other))
+
+    if type_ == "tree":
+        oid = _merge_tree_entries(o_base, o_HEAD, o_other, external, path,
+                                  conflicts)
+        return oid and ("tree", oid)
+    merged = merge_blobs(o_base, o_HEAD, o_other, external)
+    return "blob", data.hash_object(merged)
 
-    return tree
+
+def _use_external_merge():
+    """
+    Whether merge.external asks for diff3 instead of the built in merge
+    """
+    return data.get_config("merge.external", "false").lower() == "true"
 
 
-def merge_blobs(o_base, o_HEAD, o_other):
+def merge_blobs(o_base, o_HEAD, o_other, external=None):
+    """
+    Merge the lines of the blobs, conflicts are marked like diff3 -m does
+    """
+    if external is None:
+        external = _use_external_merge()
+    if external:
+        return _merge_blobs_external(o_base, o_HEAD, o_other)
+
+    base, HEAD, other = (data.get_object(oid) if oid else b""
+                         for oid in (o_base, o_HEAD, o_other))
+    return merge_contents(base, HEAD, other).content
+
+
+@trace.traced("diff subprocess")
+def _merge_blobs_external(o_base, o_HEAD, o_other):
     """
     Merge the lines in a temp files
     Pipe into stdout
@@ -100,3 +652,108 @@ def merge_blobs(o_base, o_HEAD, o_other):
             assert proc.returncode in (0, 1)
 
         return output
+
+
+# Merged content and its conflicts
+MergeResult = namedtuple("MergeResult", ["content", "conflicts"])
+# Conflict between lines start and end of the merged content (markers
+# included) with the lines of each side
+Conflict = namedtuple("Conflict", ["start", "end", "HEAD", "base", "other"])
+
+
+@trace.traced("merge")
+def merge_contents(base, HEAD, other):
+    """
+    Three way merge of the lines of base, HEAD and other
+    Lines changed on one side, or the same way on both, merge cleanly
+    Lines changed differently on both sides become a conflict region, as do
+    changes on adjacent lines: like diff3 and git, only base lines kept on
+    both sides split the regions
+    """
+    base = base.splitlines(keepends=True)
+    HEAD = HEAD.splitlines(keepends=True)
+    other = other.splitlines(keepends=True)
+
+    lines = []
+    conflicts = []
+    for region in _merge_regions(base, HEAD, other):
+        if region[0] == "unchanged":
+            lines.extend(base[region[1]:region[2]])
+        elif region[0] == "HEAD":
+            lines.extend(HEAD[region[1]:region[2]])
+        elif region[0] == "other":
+            lines.extend(other[region[1]:region[2]])
+        else:
+            _, z1, z2, a1, a2, b1, b2 = region
+            sides = HEAD[a1:a2], base[z1:z2], other[b1:b2]
+            start = len(lines)
+            for marker, side in zip((b"<<<<<<< HEAD\n", b"||||||| BASE\n",
+                                     b"=======\n"), sides):
+                lines.append(marker)
+                lines.extend(_ensure_newline(side))
+            lines.append(b">>>>>>> MERGE_HEAD\n")
+            conflicts.append(Conflict(start, len(lines),
+                                      *(b"".join(side) for side in sides)))
+
+    return MergeResult(b"".join(lines), conflicts)
+
+
+def _ensure_newline(lines):
+    """
+    Keep conflict markers on their own line after a last line with no newline
+    """
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [lines[-1] + b"\n"]
+    return lines
+
+
+def _merge_regions(base, HEAD, other):
+    """
+    Walk the regions between lines that are unchanged on both sides
+    Yield ("unchanged", z1, z2), ("HEAD", a1, a2), ("other", b1, b2)
+    or ("conflict", z1, z2, a1, a2, b1, b2)
+    """
+    z = a = b = 0
+    for z1, z2, a1, a2, b1, b2 in _sync_regions(base, HEAD, other):
+        if a1 > a or b1 > b:
+            if HEAD[a:a1] == other[b:b1]:
+                yield "HEAD", a, a1
+            elif HEAD[a:a1] == base[z:z1]:
+                yield "other", b, b1
+            elif other[b:b1] == base[z:z1]:
+                yield "HEAD", a, a1
+            else:
+                yield "conflict", z, z1, a, a1, b, b1
+
+        if z2 > z1:
+            yield "unchanged", z1, z2
+        z, a, b = z2, a2, b2
+
+
+def _sync_regions(base, HEAD, other):
+    """
+    Base lines matched on both sides, as (z1, z2, a1, a2, b1, b2) ranges of
+    base, HEAD and other, ending with an empty region at the ends
+    """
+    HEAD_blocks = _matching_blocks(base, HEAD)[:-1]
+    other_blocks = _matching_blocks(base, other)[:-1]
+
+    i = j = 0
+    while i < len(HEAD_blocks) and j < len(other_blocks):
+        z_HEAD, a, size_HEAD = HEAD_blocks[i]
+        z_other, b, size_other = other_blocks[j]
+
+        # Part of base matched in both
+        z1 = max(z_HEAD, z_other)
+        z2 = min(z_HEAD + size_HEAD, z_other + size_other)
+        if z1 < z2:
+            a1 = a + z1 - z_HEAD
+            b1 = b + z1 - z_other
+            yield z1, z2, a1, a1 + z2 - z1, b1, b1 + z2 - z1
+
+        if z_HEAD + size_HEAD < z_other + size_other:
+            i += 1
+        else:
+            j += 1
+
+    yield len(base), len(base), len(HEAD), len(HEAD), len(other), len(other)
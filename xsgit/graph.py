@@ -0,0 +1,286 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from collections import namedtuple
+
+from . import data
+
+# The commit graph keeps the tree, parents and generation number of commits
+# so history walks don't need to open and parse commit objects. It is a
+# chain of layers, new commits are written as a small layer on top and
+# layers get merged as they grow, so updates stay cheap:
+#
+# layer: "XCGR" version count base_count, fanout[256], oids[count],
+#        per commit: tree generation first_parent parent_count,
+#        parents (positions in the whole chain), and a trailing sha1
+# chain: names of the layers, bottom first
+Layer = namedtuple("Layer", ["name", "fanout", "data", "count", "base_count",
+                             "commits_start", "parents_start"])
+
+# What the graph knows about a commit
+GraphCommit = namedtuple("GraphCommit", ["tree", "parents", "generation"])
+
+_HEADER = struct.Struct(">4sIII")
+_FANOUT = struct.Struct(">256I")
+_COMMIT = struct.Struct(">20sIII")
+_PARENT = struct.Struct(">I")
+_VERSION = 1
+
+# Merge the top layer into the new one while it is less than this many
+# times bigger, keeps the number of layers logarithmic
+_MERGE_FACTOR = 2
+
+# Loaded layers per git directory
+_chains = {}
+
+
+def _graph_dir():
+    """
+    Directory holding the layers and the chain file
+    """
+    return f"{data.GIT_DIR}/objects/info/commit-graphs"
+
+
+def exists():
+    """
+    Whether the repo has a commit graph to keep up to date
+    """
+    return os.path.isfile(f"{_graph_dir()}/commit-graph-chain")
+
+
+def drop_caches():
+    """
+    Forget the loaded layers, the chain may have changed on disk
+    """
+    _chains.pop(data.GIT_DIR, None)
+
+
+def _get_layers():
+    """
+    Map the layers of the chain into memory, once per process
+    """
+    layers = _chains.get(data.GIT_DIR)
+    if layers is None:
+        layers = _read_chain()
+        _chains[data.GIT_DIR] = layers
+    return layers
+
+
+def _read_chain():
+    """
+    Map the layers the chain file names
+    A writer merging layers deletes them once it replaced the chain, the
+    chain is read again when that happens in between
+    """
+    names = None
+    while exists():
+        with open(f"{_graph_dir()}/commit-graph-chain") as f:
+            read = f.read().split()
+        try:
+            return [_open_layer(name) for name in read]
+        except FileNotFoundError:
+            if read == names:
+                raise
+            names = read
+    return []
+
+
+def _open_layer(name):
+    """
+    Map a layer and read its header and fanout table
+    """
+    with open(f"{_graph_dir()}/{name}.graph", "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, count, base_count = _HEADER.unpack_from(buf)
+    assert magic == b"XCGR" and version == _VERSION, \
+        f"Bad commit graph {name}"
+
+    fanout = _FANOUT.unpack_from(buf, _HEADER.size)
+    commits_start = _HEADER.size + _FANOUT.size + count * 20
+    parents_start = commits_start + count * _COMMIT.size
+    return Layer(name=name, fanout=fanout, data=buf, count=count,
+                 base_count=base_count, commits_start=commits_start,
+                 parents_start=parents_start)
+
+
+def _find(layer, key):
+    """
+    Binary search the oid bytes in the layer, return its local position
+    """
+    lo = layer.fanout[key[0] - 1] if key[0] else 0
+    hi = layer.fanout[key[0]]
+    oids_start = _HEADER.size + _FANOUT.size
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = oids_start + mid * 20
+        found = layer.data[pos:pos + 20]
+        if found == key:
+            return mid
+        if found < key:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return None
+
+
+def _oid_at(layers, position):
+    """
+    Oid of the commit at a position of the whole chain
+    """
+    for layer in layers:
+        if layer.base_count <= position < layer.base_count + layer.count:
+            pos = _HEADER.size + _FANOUT.size
+            pos += (position - layer.base_count) * 20
+            return layer.data[pos:pos + 20].hex()
+    assert False, f"Commit graph has no position {position}"
+
+
+def get_commit(oid):
+    """
+    Return the GraphCommit of oid, None if the graph doesn't have it
+    """
+    layers = _get_layers()
+    if not layers:
+        return None
+
+    key = bytes.fromhex(oid)
+    for layer in layers:
+        local = _find(layer, key)
+        if local is None:
+            continue
+
+        tree, generation, first, count = _COMMIT.unpack_from(
+            layer.data, layer.commits_start + local * _COMMIT.size)
+        parents = []
+        for i in range(first, first + count):
+            position, = _PARENT.unpack_from(
+                layer.data, layer.parents_start + i * _PARENT.size)
+            parents.append(_oid_at(layers, position))
+
+        return GraphCommit(tree=tree.hex(), parents=parents,
+                           generation=generation)
+
+    return None
+
+
+def add_commits(commits):
+    """
+    Add [(oid, tree, parents)] to the graph as a new layer
+    The parents of every commit must be in the graph or in commits
+    """
+    commits = list(commits)
+    if all(get_commit(oid) for oid, _, _ in commits):
+        return
+
+    # Only one writer changes the chain at a time, the others add their
+    # commits on top of what it wrote
+    os.makedirs(_graph_dir(), exist_ok=True)
+    with data.lock_file(f"{_graph_dir()}/commit-graph-chain") as f:
+        _chains.pop(data.GIT_DIR, None)
+        commits = {oid: (tree, parents) for oid, tree, parents in commits
+                   if get_commit(oid) is None}
+        if not commits:
+            return
+
+        layers = list(_get_layers())
+        # Fold the top layers in while they are not much bigger
+        while layers and layers[-1].count <= _MERGE_FACTOR * len(commits):
+            layer = layers.pop()
+            for oid, cmt in _iter_layer(layer):
+                commits.setdefault(oid, (cmt.tree, cmt.parents))
+
+        name = _write_layer(commits, layers)
+        old = [layer.name for layer in _get_layers()]
+        chain = [layer.name for layer in layers] + [name]
+        f.write("".join(f"{layer}\n" for layer in chain))
+
+    _chains.pop(data.GIT_DIR, None)
+    for layer in set(old) - set(chain):
+        os.remove(f"{_graph_dir()}/{layer}.graph")
+
+
+def _iter_layer(layer):
+    """
+    Yield (oid, GraphCommit) of every commit in the layer
+    """
+    oids_start = _HEADER.size + _FANOUT.size
+    for local in range(layer.count):
+        pos = oids_start + local * 20
+        oid = layer.data[pos:pos + 20].hex()
+        yield oid, get_commit(oid)
+
+
+def _write_layer(commits, layers):
+    """
+    Write the commits as a layer on top of layers, return its name
+    """
+    base_count = sum(layer.count for layer in layers)
+    order = sorted(commits)
+    positions = {oid: base_count + i for i, oid in enumerate(order)}
+
+    def position(oid):
+        if oid in positions:
+            return positions[oid]
+        key = bytes.fromhex(oid)
+        for layer in layers:
+            local = _find(layer, key)
+            if local is not None:
+                return layer.base_count + local
+        assert False, f"Parent {oid} is missing from the commit graph"
+
+    def generation(oid):
+        if oid not in commits:
+            return get_commit(oid).generation
+        return generations[oid]
+
+    # Parents before children, without recursing through long histories
+    generations = {}
+    for oid in order:
+        stack = [oid]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            missing = [parent for parent in commits[top][1]
+                       if parent in commits and parent not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+            generations[top] = 1 + max(
+                (generation(parent) for parent in commits[top][1]), default=0)
+            stack.pop()
+
+    fanout = [0] * 256
+    for oid in order:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    out = bytearray(_HEADER.pack(b"XCGR", _VERSION, len(order), base_count))
+    out += _FANOUT.pack(*fanout)
+    out += b"".join(bytes.fromhex(oid) for oid in order)
+
+    parents = []
+    for oid in order:
+        tree, commit_parents = commits[oid]
+        out += _COMMIT.pack(bytes.fromhex(tree), generations[oid],
+                            len(parents), len(commit_parents))
+        parents.extend(position(parent) for parent in commit_parents)
+    out += b"".join(_PARENT.pack(parent) for parent in parents)
+
+    checksum = hashlib.sha1(out).digest()
+    out += checksum
+
+    os.makedirs(_graph_dir(), exist_ok=True)
+    name = f"graph-{checksum.hex()}"
+    with tempfile.NamedTemporaryFile(dir=_graph_dir(), delete=False) as f:
+        f.write(out)
+    os.chmod(f.name, 0o444)
+    os.replace(f.name, f"{_graph_dir()}/{name}.graph")
+    return name
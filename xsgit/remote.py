@@ -1,5 +1,8 @@
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
 
 from . import base, data
 
@@ -11,12 +14,10 @@ def fetch(remote_path):
     """
     Fetch info from path passed in
     """
-    # Get ref from server
-    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
-
-    # Only fetch missing objects
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+    if is_smart_url(remote_path):
+        refs = _fetch_pack(remote_path)
+    else:
+        refs = _fetch_path(remote_path)
 
     # Update local
     for remote_name, value in refs.items():
@@ -24,30 +25,46 @@ def fetch(remote_path):
         data.update_ref(f"{LOCAL_REFS_BASE}/{refname}",
                         data.RefValue(symbolic=False, value=value))
 
+    base.update_commit_graph(refs.values())
+
+
+def _fetch_path(remote_path):
+    """
+    Copy what is missing from a repo on the file system, return its refs
+    """
+    # Get ref from server
+    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+
+    # Walk the remote's history only down to what we already have
+    local_path = os.path.dirname(data.GIT_DIR)
+    with data.change_git_dir(remote_path):
+        missing = list(base.iter_objects_in_commits(
+            refs.values(), known=lambda oid: _has_object(oid, local_path)))
+
+    # Only fetch missing objects, as one pack that becomes visible at once
+    _transfer_objects(missing, remote_path, local_path)
+    return refs
+
 
 def push(remote_path, refname):
     """
     Push the data local to remote's branch
     """
-    # Get ref data
-    remote_refs = _get_remote_refs(remote_path)
-    remote_ref = remote_refs.get(refname)
     local_ref = data.get_ref(refname).value
     assert local_ref
 
-    assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
+    if is_smart_url(remote_path):
+        _push_pack(remote_path, refname, local_ref)
+        return
 
-    # Filter out unnecessary trees or blobs
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
-    # Use set operations
-    objects_to_push = local_objects - remote_objects
+    # Get ref data
+    remote_refs = _get_remote_refs(remote_path)
+    objects_to_push = _objects_to_push(remote_refs, refname, local_ref)
 
     # Push missing objects
     # Since the commits with same thingy will have same hash
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    _transfer_objects(objects_to_push, os.path.dirname(data.GIT_DIR),
+                      remote_path)
 
     # Update server ref to local data
     with data.change_git_dir(remote_path):
@@ -55,6 +72,51 @@ def push(remote_path, refname):
             symbolic=False, value=local_ref))
 
 
+def _objects_to_push(remote_refs, refname, local_ref):
+    """
+    Check the push is a fast-forward, return the objects the remote lacks
+    """
+    remote_ref = remote_refs.get(refname)
+    assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
+
+    # Only walk down to what the remote refs already reach
+    known_remote_refs = filter(data.object_exists, remote_refs.values())
+    return list(base.iter_new_objects({local_ref}, known_remote_refs))
+
+
+def use_transfer_deltas():
+    """
+    Deltas cost time to find and are only worth it when transfer.deltas
+    says the link is slower than the CPU
+    """
+    return data.get_config("transfer.deltas", "false").lower() == "true"
+
+
+def _transfer_objects(oids, from_path, to_path):
+    """
+    Send the objects from one repo to the other as a pack stream
+    The sender writes the pack and the receiver indexes it as it reads
+    """
+    if not oids:
+        return
+
+    deltas = use_transfer_deltas()
+    with tempfile.TemporaryFile() as stream:
+        with data.change_git_dir(from_path):
+            data.write_pack_stream(stream, oids, deltas)
+        stream.seek(0)
+        with data.change_git_dir(to_path):
+            data.index_pack(stream)
+
+
+def _has_object(oid, path):
+    """
+    Whether the repo at path has the object
+    """
+    with data.change_git_dir(path):
+        return data.object_exists(oid)
+
+
 def _get_remote_refs(remote_path, prefix=""):
     """
     Make the callee function cleaner
@@ -63,6 +125,172 @@ def _get_remote_refs(remote_path, prefix=""):
         return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
 
 
+# Smart protocol, spoken with upload-pack and receive-pack of a server:
+#
+# both:    server advertises "oid refname" per ref, then a flush
+# fetch:   client sends "want oid" and "have oid" lines, then a flush,
+#          server answers with a pack of what the wants reach and the
+#          haves don't, unless there was nothing wanted
+# push:    client sends "old new refname" lines, then a flush and a pack,
+#          and closes its side, server answers "ok refname" or
+#          "ng refname reason" per ref, then a flush
+#
+# Every line is a pkt-line: four hex digits of length, counting themselves,
+# then the line, "0000" is a flush. A server that fails answers "ERR reason"
+DEFAULT_PORT = 9418
+ZERO_OID = "0" * 40
+FLUSH_PKT = b"0000"
+
+
+def is_smart_url(remote):
+    """
+    Whether the remote is a server (xsgit://host:port/path), or a server on
+    the stdio of a child process (stdio://path) rather than a path
+    """
+    return remote.startswith(("xsgit://", "stdio://"))
+
+
+def pkt_line(line):
+    """
+    Frame a line as a pkt-line
+    """
+    payload = line.encode()
+    return f"{len(payload) + 4:04x}".encode() + payload
+
+
+def read_pkt(f):
+    """
+    Return the next line without its newline, None for a flush
+    """
+    head = f.read(4)
+    assert len(head) == 4, "Connection closed by the server"
+    length = int(head, 16)
+    if not length:
+        return None
+
+    line = f.read(length - 4).decode().rstrip("\n")
+    assert not line.startswith("ERR "), f"Server error: {line[4:]}"
+    return line
+
+
+def _iter_pkts(f):
+    """
+    Yield the lines up to the next flush
+    """
+    return iter(lambda: read_pkt(f), None)
+
+
+class _Connection:
+    """
+    Streams to a server, over TCP or the stdio of a child process
+    """
+
+    def __init__(self, url, service):
+        scheme, _, rest = url.partition("://")
+        self._sock = self._proc = None
+        if scheme == "xsgit":
+            # Imported here, other commands don't pay for the module
+            import socket
+            address, _, path = rest.partition("/")
+            host, _, port = address.partition(":")
+            self._sock = socket.create_connection(
+                (host, int(port or DEFAULT_PORT)))
+            self.rfile = self._sock.makefile("rb")
+            self.wfile = self._sock.makefile("wb")
+            self.wfile.write(pkt_line(f"{service} /{path}\n"))
+            self.wfile.flush()
+        else:
+            self._proc = subprocess.Popen(
+                [sys.executable, "-m", "xsgit", service, rest],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.rfile = self._proc.stdout
+            self.wfile = self._proc.stdin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_refs(self):
+        """
+        Read the ref advertisement into {refname: oid}
+        """
+        refs = {}
+        for line in _iter_pkts(self.rfile):
+            oid, refname = line.split(" ", 1)
+            refs[refname] = oid
+        return refs
+
+    def close_write(self):
+        """
+        Tell the server everything was sent, replies can still be read
+        """
+        self.wfile.flush()
+        if self._sock:
+            import socket
+            self._sock.shutdown(socket.SHUT_WR)
+        else:
+            self.wfile.close()
+
+    def close(self):
+        if not self.wfile.closed:
+            self.wfile.close()
+        self.rfile.close()
+        if self._sock:
+            self._sock.close()
+        else:
+            self._proc.wait()
+
+
+def _fetch_pack(url):
+    """
+    Negotiate with upload-pack and store its pack, return its branches
+    """
+    with _Connection(url, "upload-pack") as conn:
+        refs = {refname: oid for refname, oid in conn.read_refs().items()
+                if refname.startswith(REMOTE_REFS_BASE)}
+
+        wants = {oid for oid in refs.values() if not data.object_exists(oid)}
+        # Local history is complete below every ref, so the ref tips are
+        # enough for the server to know where to stop
+        haves = set()
+        if wants:
+            haves = {ref.value for _, ref in data.iter_refs("refs/")
+                     if data.object_exists(ref.value)}
+
+        for oid in sorted(wants):
+            conn.wfile.write(pkt_line(f"want {oid}\n"))
+        for oid in sorted(haves):
+            conn.wfile.write(pkt_line(f"have {oid}\n"))
+        conn.wfile.write(FLUSH_PKT)
+        conn.close_write()
+
+        if wants:
+            data.index_pack(conn.rfile)
+
+    return refs
+
+
+def _push_pack(url, refname, local_ref):
+    """
+    Send the ref update and the objects it needs to receive-pack
+    """
+    with _Connection(url, "receive-pack") as conn:
+        remote_refs = conn.read_refs()
+        objects = _objects_to_push(remote_refs, refname, local_ref)
+
+        old = remote_refs.get(refname, ZERO_OID)
+        conn.wfile.write(pkt_line(f"{old} {local_ref} {refname}\n"))
+        conn.wfile.write(FLUSH_PKT)
+        data.write_pack_stream(conn.wfile, objects, use_transfer_deltas())
+        conn.close_write()
+
+        for line in _iter_pkts(conn.rfile):
+            status, _, reason = line.partition(" ")
+            assert status == "ok", f"Push rejected: {reason}"
+
+
 # For copying files
 # def update_remote_dir(remote_path):
 #     """
@@ -0,0 +1,279 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+from . import base, bitmap, data, graph, remote
+
+# Serves upload-pack (fetch) and receive-pack (push) of the smart protocol
+# described in remote.py, to one client on stdio or to many over TCP.
+# A stdio server has a single client, so it works on the repo directly.
+# Over TCP every client gets its own process running the stdio server, the
+# event loop only moves bytes, so a big fetch or push never holds up the
+# other clients
+
+_CHUNK_SIZE = 1 << 16
+
+
+async def _read_pkt(reader):
+    """
+    Return the next line without its newline, None for a flush
+    """
+    length = int(await reader.readexactly(4), 16)
+    if not length:
+        return None
+    line = await reader.readexactly(length - 4)
+    return line.decode().rstrip("\n")
+
+
+async def _read_pkts(reader):
+    """
+    Return the lines up to the next flush
+    """
+    lines = []
+    while True:
+        line = await _read_pkt(reader)
+        if line is None:
+            return lines
+        lines.append(line)
+
+
+def _advertise_refs(writer):
+    """
+    Write the refs of the current repo, followed by a flush
+    """
+    for refname, ref in data.iter_refs("refs/"):
+        writer.write(remote.pkt_line(f"{ref.value} {refname}\n"))
+    writer.write(remote.FLUSH_PKT)
+
+
+def _drop_caches():
+    """
+    Other processes may have changed the repo since the last request
+    """
+    data.drop_caches()
+    graph.drop_caches()
+    bitmap.drop_caches()
+
+
+async def upload_pack(repo, reader, writer):
+    """
+    Advertise the refs, then send a pack of what the client wants and
+    its haves don't reach
+    """
+    with data.change_git_dir(repo):
+        _drop_caches()
+        _advertise_refs(writer)
+    await writer.drain()
+
+    wants, haves = [], []
+    for line in await _read_pkts(reader):
+        kind, _, oid = line.partition(" ")
+        assert kind in ("want", "have"), f"Unexpected {line}"
+        (wants if kind == "want" else haves).append(oid)
+    if not wants:
+        return
+
+    with tempfile.TemporaryFile() as pack:
+        with data.change_git_dir(repo):
+            assert all(map(data.object_exists, wants)), "Unknown object"
+            haves = [oid for oid in haves if data.object_exists(oid)]
+            objects = list(base.iter_new_objects(wants, haves))
+            data.write_pack_stream(pack, objects,
+                                   remote.use_transfer_deltas())
+
+        pack.seek(0)
+        while True:
+            chunk = pack.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def receive_pack(repo, reader, writer):
+    """
+    Advertise the refs, store the pack the client sends, then update the
+    refs it asked for and report on each
+    """
+    with data.change_git_dir(repo):
+        _drop_caches()
+        _advertise_refs(writer)
+    await writer.drain()
+
+    updates = [line.split(" ", 2) for line in await _read_pkts(reader)]
+
+    # The pack runs until the client closes its side
+    with tempfile.TemporaryFile() as pack:
+        while True:
+            chunk = await reader.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            pack.write(chunk)
+        pack.seek(0)
+
+        with data.change_git_dir(repo):
+            data.index_pack(pack)
+            results = [_update_ref(old, new, refname)
+                       for old, new, refname in updates]
+
+    for result in results:
+        writer.write(remote.pkt_line(f"{result}\n"))
+    writer.write(remote.FLUSH_PKT)
+    await writer.drain()
+
+
+def _update_ref(old, new, refname):
+    """
+    Move a ref pushed from old to new, return the status line
+    """
+    if not refname.startswith("refs/") or ".." in refname.split("/") or \
+            refname.endswith(".lock"):
+        return f"ng {refname} bad ref name"
+
+    changed = f"ng {refname} changed since advertised, fetch first"
+    current = data.get_ref(refname).value or remote.ZERO_OID
+    if current != old:
+        return changed
+    if not _is_connected(new):
+        return f"ng {refname} missing objects"
+    if old != remote.ZERO_OID and not base.is_ancestor_of(new, old):
+        return f"ng {refname} not a fast-forward"
+
+    # Other clients push at the same time, the ref is compared again
+    # under its lock
+    try:
+        moved = data.update_ref(
+            refname, data.RefValue(symbolic=False, value=new),
+            old="" if old == remote.ZERO_OID else old)
+    except AssertionError:
+        return f"ng {refname} failed to lock"
+    if not moved:
+        return changed
+    base.update_commit_graph([new])
+    return f"ok {refname}"
+
+
+def _is_connected(oid):
+    """
+    Whether every object the commit reaches is stored, walking down to
+    the commits the refs already point to
+    """
+    tips = {ref.value for _, ref in data.iter_refs()}
+    try:
+        return all(map(data.object_exists, base.iter_objects_in_commits(
+            [oid], known=tips.__contains__)))
+    except (AssertionError, OSError, ValueError):
+        # A commit or tree of the walk is itself missing or corrupt
+        return False
+
+
+_SERVICES = {"upload-pack": upload_pack, "receive-pack": receive_pack}
+
+
+async def _serve(service, repo, reader, writer):
+    """
+    Run a service, a failure is reported to the client as ERR
+    """
+    try:
+        assert service in _SERVICES, f"Unknown service {service}"
+        assert os.path.isdir(f"{repo}/.xsgit"), f"Not a repository {repo}"
+        await _SERVICES[service](repo, reader, writer)
+    except (AssertionError, OSError, ValueError) as e:
+        writer.write(remote.pkt_line(f"ERR {e}\n"))
+    await writer.drain()
+
+
+async def _serve_process(service, repo, reader, writer):
+    """
+    Run the service as a stdio server in a child process, piped to the
+    client until the child is done
+    """
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "xsgit", service, repo,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+    # The client closing its side is passed on, receive-pack reads the
+    # pack until then
+    to_service = asyncio.create_task(
+        _copy(reader, proc.stdin, close=True))
+    try:
+        await _copy(proc.stdout, writer)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        to_service.cancel()
+        proc.stdin.close()
+        await proc.wait()
+
+
+async def _copy(reader, writer, close=False):
+    """
+    Move the bytes of reader to writer until its end, then close writer
+    when asked to
+    """
+    while True:
+        chunk = await reader.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        writer.write(chunk)
+        await writer.drain()
+    if close:
+        writer.close()
+
+
+def serve_stdio(service, repo):
+    """
+    Serve a single client on stdin and stdout
+    """
+    async def main():
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+            sys.stdout)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+        try:
+            await _serve(service, os.path.abspath(repo), reader, writer)
+            writer.close()
+            await writer.wait_closed()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client went away, nothing is left to tell it
+            writer.close()
+
+    asyncio.run(main())
+
+
+def serve_tcp(host, port, base_path):
+    """
+    Serve the repos under base_path to any number of clients
+    Clients start with a "service /path" line naming what they want
+    """
+    root = os.path.realpath(base_path)
+
+    async def handle(reader, writer):
+        try:
+            request = await _read_pkt(reader)
+            service, _, path = (request or "").partition(" ")
+            repo = os.path.realpath(os.path.join(root, path.lstrip("/")))
+            if service not in _SERVICES:
+                writer.write(remote.pkt_line(f"ERR Unknown service "
+                                             f"{service}\n"))
+            elif repo != root and not repo.startswith(root + os.sep):
+                writer.write(remote.pkt_line(f"ERR {path} is outside\n"))
+            else:
+                await _serve_process(service, repo, reader, writer)
+            writer.close()
+            await writer.wait_closed()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
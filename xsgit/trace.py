@@ -0,0 +1,184 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict
+
+# Tracing times the phases of a command (history walks, hashing, object
+# reads and writes, tree parsing, ref I/O...) and counts calls and bytes.
+# It is off unless enable() is called, the functions it wraps then only
+# cost a flag check. Phases nest, their times are inclusive and summed
+# over the threads running them
+
+_enabled = False
+_start = None
+# Phase name to [calls, seconds]
+_phases = defaultdict(lambda: [0, 0.0])
+_counters = defaultdict(int)
+# Chrome trace events, only kept when a trace file was asked for
+_events = None
+_trace_file = None
+_lock = threading.Lock()
+# Phases each thread is in, a phase entered again inside itself (by
+# recursion) is only timed once
+_local = threading.local()
+
+# Flag of the code of generator functions, inspect costs too much to import
+# for it
+_CO_GENERATOR = 0x20
+
+
+def enable(trace_file=None):
+    """
+    Start tracing, the events also go to trace_file in the Chrome trace
+    event format when given
+    """
+    global _enabled, _start, _events, _trace_file
+    _enabled = True
+    _start = time.perf_counter()
+    _trace_file = trace_file
+    _events = [] if trace_file else None
+
+
+def is_enabled():
+    return _enabled
+
+
+def count(name, n=1):
+    """
+    Add n to a counter
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] += n
+
+
+class _Span:
+    """
+    Times one run of a phase
+    """
+
+    def __init__(self, name, call=True):
+        self.name = name
+        self.call = call
+
+    def __enter__(self):
+        active = getattr(_local, "active", None)
+        if active is None:
+            active = _local.active = set()
+        self.outer = self.name not in active
+        if self.outer:
+            active.add(self.name)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        if not self.outer:
+            return
+        _local.active.discard(self.name)
+
+        with _lock:
+            phase = _phases[self.name]
+            phase[0] += self.call
+            phase[1] += end - self.start
+            if _events is not None:
+                _events.append({
+                    "name": self.name, "cat": "xsgit", "ph": "X",
+                    "ts": (self.start - _start) * 1e6,
+                    "dur": (end - self.start) * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident()})
+
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def phase(name):
+    """
+    Context manager timing the block as a run of the phase
+    """
+    return _Span(name) if _enabled else _NO_SPAN
+
+
+def traced(name=None, counter=None):
+    """
+    Decorator timing each call as a run of the phase name and counting
+    the calls in counter
+    Generators are timed while they compute their next item, not while
+    the caller works with it
+    """
+    def decorator(func):
+        generator = bool(func.__code__.co_flags & _CO_GENERATOR)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            if counter:
+                count(counter)
+            if name is None:
+                return func(*args, **kwargs)
+            if generator:
+                return _iter_steps(name, func(*args, **kwargs))
+            with _Span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _iter_steps(name, items):
+    """
+    Yield from items, timing the steps as one run of the phase
+    """
+    call = True
+    while True:
+        with _Span(name, call):
+            call = False
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+
+def report(extra=None):
+    """
+    Print the summary on stderr and write the trace file
+    Counters of extra are reported along with the others
+    """
+    if not _enabled:
+        return
+    wall = time.perf_counter() - _start
+    counters = dict(_counters, **(extra or {}))
+
+    out = [f"xsgit trace: {wall:.3f}s",
+           f"  {'phase':24} {'calls':>10} {'seconds':>10} {'wall%':>7}"]
+    for name, (calls, seconds) in sorted(_phases.items(),
+                                         key=lambda item: -item[1][1]):
+        out.append(f"  {name:24} {calls:10} {seconds:10.3f} "
+                   f"{100 * seconds / wall:7.1f}")
+    out.append(f"  {'counter':24} {'value':>10}")
+    for name, value in sorted(counters.items()):
+        out.append(f"  {name:24} {value:10}")
+    print("\n".join(out), file=sys.stderr)
+
+    if _trace_file:
+        events = list(_events)
+        events.append({"name": "process_name", "ph": "M", "pid": os.getpid(),
+                       "args": {"name": " ".join(["xsgit"] + sys.argv[1:])}})
+        events.append({"name": "counters", "ph": "C", "ts": wall * 1e6,
+                       "pid": os.getpid(), "args": counters})
+        with open(_trace_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)